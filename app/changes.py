@@ -0,0 +1,210 @@
+"""
+Incremental sync of the catalogue from the ChangeLog.
+
+Usage: python -m app.changes [--since CURSOR] [--limit N] [--compact]
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import operator
+import sqlite3
+import sys
+import threading
+import typing
+
+from . import DB_PATH
+from .db_utils import MAX_IN_LIST, SQL_SelectTempl, connect, exec_statement
+from .dim_cache import DIMENSION_TABLES
+from .shards import CHANGE_LOG_SEQ_SPAN, change_log_position, change_log_schemas, select_changes
+from .sql_statements import (
+    COMPACT_SCHEMA_CHANGE_LOG_TEMPL,
+    SELECT_GPU_ROWS_TEMPL,
+)
+
+DEFAULT_LIMIT = 1000
+# compact once this many entries were logged since the last compaction
+COMPACT_EVERY = 10000
+_compact_lock = threading.Lock()
+# change log schema -> its last seq at the last compaction
+_compacted_seqs: dict[str, int] = {}
+
+# table name -> (select template, quoted key column)
+ROW_TEMPLS: dict[str, tuple[SQL_SelectTempl, str]] = {
+    **DIMENSION_TABLES,
+    'GPU': (SELECT_GPU_ROWS_TEMPL, r'GPU.id'),
+}
+
+
+def _fetch_rows(con: sqlite3.Connection, table: str, row_ids: list[int]) -> dict[int, dict[str, typing.Any]]:
+    """The current rows of a table by id, with one IN-list query per MAX_IN_LIST ids"""
+    templ, key = ROW_TEMPLS[table]
+    rows = {}
+    for start in range(0, len(row_ids), MAX_IN_LIST):
+        result = templ.where(key, operator.contains, row_ids[start:start + MAX_IN_LIST]).execute_on_dbcon(con, lazy=True)
+        for row in result:
+            # the key is the first column of every row template
+            rows[row[result.header[0]]] = row
+    return rows
+
+
+def parse_cursor(raw: str) -> tuple[int, ...]:
+    """
+    Parse a cursor of changes_since into a change log position.
+
+    The cursor is the last seq read from the change log, or for a sharded database the last seq read
+    from every change log relative to the start of its range, joined by dots. A cursor with fewer
+    seqs than there are change logs (e.g. from before the database was sharded) reads the others from their start.
+
+    >>> parse_cursor('31')
+    (31,)
+    >>> parse_cursor('31.2') == (31, CHANGE_LOG_SEQ_SPAN + 2)
+    True
+    >>> parse_cursor('-1')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid change log cursor: -1
+    """
+    position = []
+    for log_no, part in enumerate(raw.split('.')):
+        seq = int(part)
+        if not 0 <= seq < CHANGE_LOG_SEQ_SPAN:
+            raise ValueError(f'Invalid change log cursor: {raw}')
+        position.append(log_no * CHANGE_LOG_SEQ_SPAN + seq)
+    return tuple(position)
+
+
+def fmt_cursor(position: tuple[int, ...]) -> int | str:
+    """
+    The cursor of a change log position, see parse_cursor
+
+    >>> fmt_cursor((31,))
+    31
+    >>> fmt_cursor(parse_cursor('31.2.0'))
+    '31.2.0'
+    """
+    if len(position) == 1:
+        return position[0]
+    return '.'.join(str(seq - log_no * CHANGE_LOG_SEQ_SPAN) for log_no, seq in enumerate(position))
+
+
+def changes_since(con: sqlite3.Connection, since: tuple[int, ...] = (0,),
+                  limit: int = DEFAULT_LIMIT) -> dict[str, typing.Any]:
+    """
+    Get the rows inserted, updated or deleted after a change log position.
+
+    Only the latest change of each row is guaranteed to be kept, so changes are returned with the
+    current state of their row, or None if it was deleted since.
+
+    :param since: parse_cursor() of the `next` value of the previous call, (0,) for everything
+    :param limit: The maximum number of changes to return
+    :return: A dict with the changes, the `next` cursor to pass as since,
+        and whether there are `more` changes after it
+    """
+    until = change_log_position(con)
+    results = (templ.order_by(r'seq', is_asc=True).execute_on_dbcon(con, lazy=True)
+               for templ in select_changes(since, until))
+    changes = list(itertools.islice(itertools.chain.from_iterable(results), limit + 1))
+    more = len(changes) > limit
+    changes = changes[:limit]
+    if more:
+        position = list(since) + [log_no * CHANGE_LOG_SEQ_SPAN for log_no in range(len(since), len(until))]
+        for change in changes:
+            position[change['seq'] // CHANGE_LOG_SEQ_SPAN] = change['seq']
+    else:
+        position = until
+
+    # one query per changed table, not per change
+    ids_by_table: dict[str, dict[int, None]] = {}
+    for change in changes:
+        ids_by_table.setdefault(change['table_name'], {})[change['row_id']] = None
+    rows = {table: _fetch_rows(con, table, list(ids)) for table, ids in ids_by_table.items()}
+
+    return {
+        'since': fmt_cursor(since),
+        'next': fmt_cursor(tuple(position)),
+        'more': more,
+        'changes': [{
+            'seq': change['seq'],
+            'table': change['table_name'],
+            'id': change['row_id'],
+            'op': change['op'],
+            'row': rows[change['table_name']].get(change['row_id']),
+        } for change in changes],
+    }
+
+
+def compact_change_log(con: sqlite3.Connection, schemas: typing.Iterable[str] | None = None) -> int:
+    """
+    Drop every change superseded by a later change of the same row, returns the number dropped
+
+    :param schemas: The change logs to compact, None for all of them
+
+    The latest change of every row is kept, so the change log position does not go back:
+
+    >>> from app.setup import reg_arch, setup_table
+    >>> con = sqlite3.connect(':memory:')
+    >>> setup_table(con)
+    >>> arch_id = reg_arch(con, 'Old name')
+    >>> _ = con.execute('UPDATE Architecture SET arch_name = ? WHERE arch_id = ?', ('New name', arch_id))
+    >>> change_log_position(con)
+    (2,)
+    >>> compact_change_log(con)
+    1
+    >>> change_log_position(con)
+    (2,)
+    >>> [(change['seq'], change['op']) for change in changes_since(con)['changes']]
+    [(2, 'update')]
+    """
+    return sum(exec_statement(con, COMPACT_SCHEMA_CHANGE_LOG_TEMPL.format(schema=schema)).rowcount
+               for schema in (change_log_schemas(con) if schemas is None else schemas))
+
+
+def maybe_compact_change_log(con: sqlite3.Connection) -> int:
+    """
+    Compact the change logs with COMPACT_EVERY entries logged since their last compaction in this process.
+
+    Called by the write functions of app.setup, so that it runs in the transaction of the write,
+    which the database serializes with the writes and compactions of other connections.
+    A change log is only written to when it grew, so a write to a shard does not lock the others.
+    """
+    with _compact_lock:
+        due = []
+        for schema, last_seq in zip(change_log_schemas(con), change_log_position(con)):
+            # first write in this process, compact soon but not right away
+            compacted_seq = _compacted_seqs.setdefault(schema, last_seq)
+            if last_seq < compacted_seq:
+                # another database
+                _compacted_seqs[schema] = last_seq
+            elif last_seq - compacted_seq >= COMPACT_EVERY:
+                _compacted_seqs[schema] = last_seq
+                due.append(schema)
+        return compact_change_log(con, due) if due else 0
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog='python -m app.changes',
+                                     description='Print the catalogue changes after a sequence number as JSON lines')
+    parser.add_argument('--since', type=parse_cursor, default=(0,), metavar='CURSOR',
+                        help='the next cursor printed by a previous run')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT,
+                        help='changes per batch, all batches are printed')
+    parser.add_argument('--compact', action='store_true', help='compact the change log instead')
+    args = parser.parse_args(argv)
+    with connect(DB_PATH) as con:
+        if args.compact:
+            print(f'Dropped {compact_change_log(con)} superseded changes', file=sys.stderr)
+            return
+        since = args.since
+        while True:
+            batch = changes_since(con, since, args.limit)
+            for change in batch['changes']:
+                print(json.dumps(change, separators=(',', ':')))
+            since = parse_cursor(str(batch['next']))
+            if not batch['more']:
+                break
+    print(f'Next cursor: {fmt_cursor(since)}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
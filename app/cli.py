@@ -1,5 +1,5 @@
 from . import DB_PATH
-from .db_utils import exec_statement, fetch_all_from_cursor
+from .db_utils import connect, exec_statement, fetch_all_from_cursor
 from .setup import (
     setup_table,
     reg_arch,
@@ -7,22 +7,22 @@ from .setup import (
     reg_manufacturer,
     reg_series,
     reg_proc,
+    reg_price,
+    upgrade_table,
 )
 from .sql_statements import SELECT_GET_GPU_DETAILS_TEMPL
-from .utils import fmt_table, fancy_console_menu, reset_cursor, SuppressAndExec, make_reg_callback
+from .utils import fmt_table, fancy_console_menu, console_pager, reset_cursor, SuppressAndExec, make_reg_callback
 
 import functools
 import os.path
-import sqlite3
 import sys
-import time
 
 RETURN_TIMEOUT = 3
 
 
 def main():
     db_existed = os.path.exists(DB_PATH)
-    with sqlite3.connect(DB_PATH) as con:
+    with connect(DB_PATH) as con:
         if not db_existed:
             print(f'Database "{DB_PATH}" does not exist, '
                   f'Setting up a new table!')
@@ -33,20 +33,21 @@ def main():
             mid = reg_manufacturer(con, 'Nvidia', 1993)
             reg_gpu(con, 'RTX 4090', pid, 2235, sid, mid, 24, 159900)
             con.commit()
+        else:
+            upgrade_table(con)
+            con.commit()
 
         def print_all_gpus_fn(idx, name, fn, d):
-            def print_gpu_menu_opt(timeout, *exceptions):
+            def print_gpu_menu_opt(*exceptions):
                 def pgpu_decorator(func):
                     @functools.wraps(func)
                     def wrapper(idx_inner, *args, **kwargs):
-                        with SuppressAndExec(tuple({KeyboardInterrupt, *exceptions}), print_all_gpus_fn, idx_inner, name, fn, d):
-                            reset_cursor()
-                            print(func(*args, **kwargs), end='')
-                            time.sleep(timeout)
+                        with SuppressAndExec(tuple({KeyboardInterrupt, EOFError, *exceptions}), print_all_gpus_fn, idx_inner, name, fn, d):
+                            console_pager(func(*args, **kwargs))
                     return wrapper
                 return pgpu_decorator
 
-            @print_gpu_menu_opt(RETURN_TIMEOUT)
+            @print_gpu_menu_opt()
             def perf_desc(*_args, **_kwargs):
                 return fmt_table(fetch_all_from_cursor(exec_statement(
                     con, (
@@ -55,7 +56,7 @@ def main():
                         .order_by(r'GPU.vram_size_gb', is_asc=False)
                         .statement))))
 
-            @print_gpu_menu_opt(RETURN_TIMEOUT)
+            @print_gpu_menu_opt()
             def price_desc(*_args, **_kwargs):
                 return fmt_table(fetch_all_from_cursor(exec_statement(
                     con, (
@@ -64,7 +65,7 @@ def main():
                         .statement
                     ))))
 
-            @print_gpu_menu_opt(RETURN_TIMEOUT)
+            @print_gpu_menu_opt()
             def price_asc(*_args, **_kwargs):
                 return fmt_table(fetch_all_from_cursor(exec_statement(
                     con, (
@@ -100,6 +101,7 @@ def main():
                 ('Register a new GPU series', make_reg_cb_partial(reg_series, 'Series')),
                 ('Register a new GPU manufacturer', make_reg_cb_partial(reg_manufacturer, 'Manufacturer')),
                 ('Register a new GPU', make_reg_cb_partial(reg_gpu, 'GPU')),
+                ('Register a new GPU price', make_reg_cb_partial(reg_price, 'GPU price')),
                 ('Exit', exit_),
             ], default_idx=-1)[2])
 
@@ -1,8 +1,21 @@
 import copy
 import sqlite3
 import operator
-from typing import Any
+import threading
+import time
+from typing import Any, Iterator
 from . import DB_PATH
+from .metrics import (
+    CONNECTIONS_CLOSED,
+    CONNECTIONS_OPENED,
+    ROWS_FETCHED,
+    STATEMENT_DURATION,
+    statement_label,
+)
+
+_connections = threading.local()
+# keep IN lists below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+MAX_IN_LIST = 999
 
 
 class SQL_StatementTemplate:
@@ -65,14 +78,23 @@ class SQL_StatementTemplate:
         """Const method to get the statement and params."""
         return self.statement, self.params
 
-    def execute_on_dbcon(self, con: sqlite3.Connection):
-        return exec_statement(con, *self.stmt_and_params)
+    def execute_on_dbcon(self, con: sqlite3.Connection, lazy: bool = False):
+        """
+        Execute the statement.
+
+        :param lazy: True to get a QueryResult instead of the cursor
+        :return: The cursor, or a QueryResult wrapping it
+        """
+        cursor = exec_statement(con, *self.stmt_and_params)
+        return QueryResult(cursor) if lazy else cursor
 
 
 class SQL_SelectTempl(SQL_StatementTemplate):
-    def __init__(self, statement: str, copy_on_modify: bool = True, conditions: list = None, order_by: list = None):
+    def __init__(self, statement: str, copy_on_modify: bool = True, conditions: list = None, order_by: list = None,
+                 group_by: list = None):
         self._conditions = [] if conditions is None else conditions
         self._order_by = [] if order_by is None else order_by
+        self._group_by = [] if group_by is None else group_by
         super().__init__(statement, copy_on_modify)
 
     def _op2sql(self, op):
@@ -88,6 +110,8 @@ class SQL_SelectTempl(SQL_StatementTemplate):
             return '<'
         elif op is operator.le:
             return '<='
+        elif op is operator.contains:
+            return 'IN'
         else:
             raise ValueError(f'Invalid operator: {op}')
 
@@ -96,12 +120,19 @@ class SQL_SelectTempl(SQL_StatementTemplate):
 
     def _get_more(self):
         def cond2sql(condition):
+            if condition[1] is operator.contains:
+                return f'{condition[0]} IN ({", ".join("?" * len(condition[2]))})'
             return f'{condition[0]} {self._op2sql(condition[1])} ?'
         if self._conditions:
             self = self._modify()
             self._statement = self._add_more('WHERE')
             self._statement = self._add_more(' AND '.join(cond2sql(condition) for condition in self._conditions))
 
+        if self._group_by:
+            self = self._modify()
+            self._statement = self._add_more('GROUP BY')
+            self._statement = self._add_more(', '.join(self._group_by))
+
         def order_by2sql(order):
             return f'{order[0]} {self._order2sql(order[1])}'
         if self._order_by:
@@ -111,19 +142,37 @@ class SQL_SelectTempl(SQL_StatementTemplate):
         return self
 
     def _get_params(self):
-        return tuple(condition[2] for condition in self._conditions)
+        params = []
+        for condition in self._conditions:
+            if condition[1] is operator.contains:
+                params.extend(condition[2])
+            else:
+                params.append(condition[2])
+        return tuple(params)
 
     def where(self, quoted_col: str, op: type[operator.eq], value):
         """
         Add a WHERE condition to the SQL statement. (If there are multiple conditions, they are ANDed together.)
 
         :param quoted_col: a string representing the column name, needs to be quoted manually if necessary
-        :param op: one of operator.eq, operator.ne, operator.gt, operator.lt, operator.ge, operator.le
-        :param value: anything that can be converted to a string
+        :param op: one of operator.eq, operator.ne, operator.gt, operator.lt, operator.ge, operator.le,
+            or operator.contains for `quoted_col IN value`
+        :param value: anything that can be converted to a string, or an iterable of those for operator.contains
+        :return: self
+        """
+        self = self._modify()
+        self._conditions.append((quoted_col, op, tuple(map(str, value)) if op is operator.contains else str(value)))
+        return self
+
+    def group_by(self, quoted_col: str):
+        """
+        Add a column to the GROUP BY clause of the SQL statement.
+
+        :param quoted_col: a string representing the column name or alias
         :return: self
         """
         self = self._modify()
-        self._conditions.append((quoted_col, op, str(value)))
+        self._group_by.append(quoted_col)
         return self
 
     def order_by(self, quoted_col: str, is_asc: bool):
@@ -143,13 +192,21 @@ def exec_statements(db_conn: sqlite3.Connection, *statements) -> sqlite3.Cursor:
     """Execute statements given a connection"""
     cursor = db_conn.cursor()
     for statement in statements:
-        cursor.execute(statement)
+        start = time.perf_counter()
+        try:
+            cursor.execute(statement)
+        finally:
+            STATEMENT_DURATION.observe(time.perf_counter() - start, statement_label(statement))
     return cursor
 
 
 def exec_statement(db_conn: sqlite3.Connection, statement: str, params=()) -> sqlite3.Cursor:
     """Execute a statement with parameters"""
-    return db_conn.cursor().execute(statement, params)
+    start = time.perf_counter()
+    try:
+        return db_conn.cursor().execute(statement, params)
+    finally:
+        STATEMENT_DURATION.observe(time.perf_counter() - start, statement_label(statement))
 
 
 def get_header_from_cursor(cursor: sqlite3.Cursor) -> list[str | Any]:
@@ -161,6 +218,7 @@ def fetch_all_from_cursor(cursor: sqlite3.Cursor,
                           header: bool = True) -> list[tuple[Any, ...]]:
     """Fetch all rows from a cursor"""
     r = cursor.fetchall()
+    ROWS_FETCHED.inc(amount=len(r))
     if header:
         return (get_header_from_cursor(cursor), *r)
     return r
@@ -170,32 +228,93 @@ def fetch_many_from_cursor(cursor: sqlite3.Cursor,
                            size: int = 1, header: bool = True) -> list[tuple[Any, ...]]:
     """Fetch one or many rows from a cursor"""
     r = cursor.fetchmany(size)
+    ROWS_FETCHED.inc(amount=len(r))
     if header:
         return (get_header_from_cursor(cursor), *r)
     return r
 
 
-def get_connection() -> sqlite3.Connection:
+def fetch_chunks_from_cursor(cursor: sqlite3.Cursor,
+                             size: int | None = None) -> Iterator[list[tuple[Any, ...]]]:
+    """Lazily fetch the rows from a cursor in chunks of at most size rows, without the header"""
+    size = cursor.arraysize if size is None else size
+    while rows := cursor.fetchmany(size):
+        ROWS_FETCHED.inc(amount=len(rows))
+        yield rows
+
+
+class QueryResult:
+    """
+    The rows of an executed query, fetched from the cursor in cursor.arraysize batches as they are iterated.
+
+    Iterating gives the rows as dicts keyed by the header, so a result can be passed to a template
+    as is. Like the cursor it wraps, a result can only be iterated once.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+        self.header = get_header_from_cursor(cursor)
+
+    def tuples(self) -> Iterator[tuple[Any, ...]]:
+        """Iterate the rows as tuples in the order of the header"""
+        for chunk in fetch_chunks_from_cursor(self.cursor):
+            yield from chunk
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        header = self.header
+        for row in self.tuples():
+            yield dict(zip(header, row))
+
+    def first(self) -> dict[str, Any] | None:
+        """Get the first row, or None if there are no rows. The other rows are discarded."""
+        row = self.cursor.fetchone()
+        self.cursor.close()
+        if row is None:
+            return None
+        ROWS_FETCHED.inc()
+        return dict(zip(self.header, row))
+
+    def one(self) -> dict[str, Any]:
+        """Get the only row, raises ValueError if there are none or more than one"""
+        rows = self.cursor.fetchmany(2)
+        self.cursor.close()
+        ROWS_FETCHED.inc(amount=len(rows))
+        if len(rows) != 1:
+            raise ValueError(f'Expected one row, got {"none" if not rows else "more than one"}')
+        return dict(zip(self.header, rows[0]))
+
+
+def connect(path: str | None = None) -> sqlite3.Connection:
     """
-    Lazy init db connection
+    Open a database, with its GPU shards attached if it is sharded
+
+    :param path: The database file, None for DB_PATH
+    """
+    # shards builds on the statements of this module
+    from .shards import attach_shards
+    con = sqlite3.connect(DB_PATH if path is None else path)
+    attach_shards(con)
+    return con
+
+
+def get_connection(path: str | None = None) -> sqlite3.Connection:
+    """
+    Lazy init db connection, one per thread since sqlite3 connections cannot be shared
     It's the caller's duty to close the connection!
+
+    :param path: The database file to open if this thread has no connection yet, None for DB_PATH
     """
-    if not hasattr(get_connection, 'lock'):
-        import threading
-        get_connection.lock = threading.Lock()
-    with get_connection.lock:
-        if not hasattr(get_connection, 'con') or get_connection.con is None:
-            get_connection.con = sqlite3.connect(DB_PATH)
-        return get_connection.con
+    if getattr(_connections, 'con', None) is None:
+        _connections.con = connect(path)
+        CONNECTIONS_OPENED.inc()
+    return _connections.con
 
 
 def destroy_connection():
     """
-    Close the connection from get_connection
+    Close the connection from get_connection in this thread
     """
-    if not hasattr(get_connection, 'lock'):
-        return  # not initialised
-    with get_connection.lock:
-        if hasattr(get_connection, "con") and get_connection.con is not None:
-            get_connection.con.close()
-            get_connection.con = None
+    if getattr(_connections, 'con', None) is not None:
+        _connections.con.close()
+        _connections.con = None
+        CONNECTIONS_CLOSED.inc()
@@ -0,0 +1,218 @@
+"""
+Process-wide identity cache for the small dimension tables
+(Architecture, Processor, Series and Manufacturer).
+
+GPU rows are fetched from the GPU table alone and enriched from this cache,
+instead of joining every dimension table on every query.
+"""
+from __future__ import annotations
+import collections
+import operator
+import sqlite3
+import threading
+import time
+import typing
+
+from .db_utils import SQL_SelectTempl
+from .metrics import register_cache
+from .shards import change_log_position, position_follows, select_changes
+from .sql_statements import (
+    SELECT_ARCH_ROWS,
+    SELECT_MANU_ROWS,
+    SELECT_PROC_ROWS,
+    SELECT_SERIES_ROWS,
+)
+
+MAX_ENTRIES = 4096
+# how often refresh() looks at the ChangeLog, writes of this process invalidate the cache right away
+REFRESH_INTERVAL_S = 0.5
+
+# table name -> (select template, key column)
+DIMENSION_TABLES: dict[str, tuple[SQL_SelectTempl, str]] = {
+    'Architecture': (SELECT_ARCH_ROWS, 'arch_id'),
+    'Processor': (SELECT_PROC_ROWS, 'proc_id'),
+    'Series': (SELECT_SERIES_ROWS, 'series_id'),
+    'Manufacturer': (SELECT_MANU_ROWS, 'manufacturer_id'),
+}
+
+
+class DimensionCache:
+    """
+    A bounded, thread-safe cache of dimension rows keyed by (table, id).
+
+    Each table is loaded in bulk on first use, up to max_entries rows, and reloaded
+    after it is written to. Writes of other processes (e.g. the CLI) are picked up from
+    the ChangeLog by refresh(). Rows that are not cached (because they were evicted) are
+    looked up individually and added, evicting the least recently used row of the table when it is full.
+    Ids that do not exist are cached as missing, until the table is invalidated.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, refresh_interval: float = REFRESH_INTERVAL_S):
+        """
+        :param max_entries: The maximum number of rows cached per table
+        :param refresh_interval: The minimum number of seconds between two ChangeLog checks of refresh()
+        """
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # id -> row, or None for an id that does not exist
+        self._tables: dict[str, collections.OrderedDict[int, dict[str, typing.Any] | None]] = {}
+        # bumped by every invalidation, so that a load started before one is not stored after it
+        self._generation = 0
+        # the change_log_position of the last refresh
+        self._seq: tuple[int, ...] | None = None
+        self._refreshed_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, con: sqlite3.Connection, table: str) -> collections.OrderedDict:
+        templ, key = DIMENSION_TABLES[table]
+        rows = collections.OrderedDict()
+        for row in templ.order_by(key, is_asc=True).execute_on_dbcon(con, lazy=True):
+            if len(rows) >= self.max_entries:
+                break
+            rows[row[key]] = row
+        return rows
+
+    def _lookup(self, con: sqlite3.Connection, table: str, id_: int) -> dict[str, typing.Any] | None:
+        templ, key = DIMENSION_TABLES[table]
+        return templ.where(key, operator.eq, id_).execute_on_dbcon(con, lazy=True).first()
+
+    def _table(self, con: sqlite3.Connection, table: str) -> collections.OrderedDict:
+        with self._lock:
+            rows = self._tables.get(table)
+            generation = self._generation
+        if rows is None:
+            rows = self._load(con, table)
+            with self._lock:
+                if generation == self._generation:
+                    self._tables[table] = rows
+        return rows
+
+    def refresh(self, con: sqlite3.Connection):
+        """
+        Invalidate the tables written to since the last refresh, by any process. Call once per request,
+        the ChangeLog is only read if refresh_interval passed since the last time.
+        """
+        now = time.monotonic()
+        with self._lock:
+            seq = self._seq
+            if seq is not None and now - self._refreshed_at < self.refresh_interval:
+                return
+            self._refreshed_at = now
+        last_seq = change_log_position(con)
+        if last_seq == seq:
+            return
+        if seq is None or not position_follows(last_seq, seq):
+            # first refresh, or another database
+            self.invalidate()
+        else:
+            tables = set()
+            for templ in select_changes(seq, last_seq):
+                changes = (templ
+                           .where(r'table_name', operator.contains, tuple(DIMENSION_TABLES))
+                           .execute_on_dbcon(con, lazy=True))
+                tables.update(table for _, table, _, _ in changes.tuples())
+            for table in tables:
+                self.invalidate(table)
+        with self._lock:
+            self._seq = last_seq
+
+    def get(self, con: sqlite3.Connection, table: str, id_: int) -> dict[str, typing.Any] | None:
+        """
+        Get a dimension row by its id.
+
+        :param con: The connection used to load the table or look up a missing row
+        :param table: One of the keys of DIMENSION_TABLES
+        :param id_: The primary key of the row
+        :return: The row as a dict, or None if it does not exist. Do not modify it, it is shared.
+        """
+        rows = self._table(con, table)
+        with self._lock:
+            if id_ in rows:
+                self.hits += 1
+                rows.move_to_end(id_)
+                return rows[id_]
+            self.misses += 1
+        row = self._lookup(con, table, id_)
+        with self._lock:
+            rows[id_] = row
+            while len(rows) > self.max_entries:
+                rows.popitem(last=False)
+        return row
+
+    def find(self, con: sqlite3.Connection, table: str, col: str, value) -> list[dict[str, typing.Any]]:
+        """Get all the rows of a table with row[col] == value, e.g. the processors of an architecture"""
+        rows = self._table(con, table)
+        with self._lock:
+            if len(rows) < self.max_entries:
+                self.hits += 1
+                return [row for row in rows.values() if row is not None and row[col] == value]
+            self.misses += 1
+        # the table does not fit, ask the database
+        templ, _ = DIMENSION_TABLES[table]
+        return list(templ.where(col, operator.eq, value).execute_on_dbcon(con, lazy=True))
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': sum(len(rows) for rows in self._tables.values()),
+            }
+
+    def invalidate(self, table: str | None = None):
+        """Drop a table (or all the tables) from the cache, they are reloaded on next use"""
+        with self._lock:
+            self._generation += 1
+            if table is None:
+                self._tables.clear()
+                self._seq = None
+            else:
+                self._tables.pop(table, None)
+
+    def enrich_gpu(self, con: sqlite3.Connection, gpu: dict[str, typing.Any]) -> dict[str, typing.Any] | None:
+        """
+        Add the dimension columns to a row from SELECT_GPU_ROWS_TEMPL, giving the same
+        columns as SELECT_GPU_DETAILS_WITH_ID_TEMPL.
+
+        :return: The enriched row, or None if a dimension row is missing (like an inner join would)
+        """
+        proc = self.get(con, 'Processor', gpu['proc_id'])
+        arch = proc and self.get(con, 'Architecture', proc['arch_id'])
+        series = self.get(con, 'Series', gpu['series_id'])
+        manu = self.get(con, 'Manufacturer', gpu['manufacturer_id'])
+        if not (proc and arch and series and manu):
+            return None
+        return {
+            'id': gpu['id'],
+            'name': gpu['name'],
+            'proc_id': proc['proc_id'],
+            'proc_name': proc['proc_name'],
+            'arch_id': arch['arch_id'],
+            'arch_name': arch['arch_name'],
+            'clock_speed_mhz': gpu['clock_speed_mhz'],
+            'series_id': series['series_id'],
+            'series_name': series['series_name'],
+            'release_year': series['release_year'],
+            'manufacturer_id': manu['manufacturer_id'],
+            'manufacturer_name': manu['manufacturer_name'],
+            'founded_year': manu['founded_year'],
+            'vram_size_gb': gpu['vram_size_gb'],
+            'price_cents': gpu['price_cents'],
+        }
+
+    def iter_enrich_gpus(self, con: sqlite3.Connection,
+                         gpus: typing.Iterable[dict[str, typing.Any]]) -> typing.Iterator[dict[str, typing.Any]]:
+        """Lazy enrich_gpus, e.g. to stream a QueryResult into a template"""
+        for gpu in gpus:
+            row = self.enrich_gpu(con, gpu)
+            if row is not None:
+                yield row
+
+    def enrich_gpus(self, con: sqlite3.Connection, gpus: typing.Iterable[dict[str, typing.Any]]) -> list[dict[str, typing.Any]]:
+        return list(self.iter_enrich_gpus(con, gpus))
+
+
+DIM_CACHE = DimensionCache()
+register_cache('dimension', DIM_CACHE.stats)
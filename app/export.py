@@ -0,0 +1,283 @@
+"""
+Streaming export of the joined GPU catalogue.
+
+Usage: python -m app.export OUTPUT [--format csv|jsonl|col] [--compress gzip|bz2|xz] [--resume]
+"""
+from __future__ import annotations
+import argparse
+import array
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import operator
+import os.path
+import sqlite3
+import struct
+import sys
+import typing
+
+from . import DB_PATH
+from .db_utils import connect, fetch_chunks_from_cursor, get_header_from_cursor
+from .sql_statements import SELECT_GPU_DETAILS_WITH_ID_TEMPL
+
+CHUNK_SIZE = 4096
+WRITE_BUFFER_SIZE = 1 << 20
+ID_COLUMN = 'id'
+
+# every chunk is compressed into a complete stream of its own, and the decompressors read
+# concatenated streams, so the file is valid up to the last saved progress at all times
+COMPRESSORS: dict[str | None, typing.Callable[[bytes], bytes]] = {
+    None: lambda data: data,
+    'gzip': gzip.compress,
+    'bz2': bz2.compress,
+    'xz': lzma.compress,
+}
+DECOMPRESSORS: dict[str | None, typing.Callable[[typing.BinaryIO], typing.BinaryIO]] = {
+    None: lambda f: f,
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+    'bz2': lambda f: bz2.BZ2File(f, mode='rb'),
+    'xz': lambda f: lzma.LZMAFile(f, mode='rb'),
+}
+
+# Columnar file layout, all integers little endian:
+#   header: COL_MAGIC, u16 column count, then per column u16 length + utf-8 name
+#   chunks: u32 row count, then per column a u8 type tag, a null bitmap of
+#           ceil(rows / 8) bytes and the values of the non-null cells:
+#           COL_INT   -> int64 array
+#           COL_TEXT  -> u32 byte length array followed by the utf-8 bytes
+# Chunks are self contained, so a resumed export simply appends more of them.
+COL_MAGIC = b'GPUCOL1\n'
+COL_INT = 0
+COL_TEXT = 1
+
+
+def le_bytes(arr: array.array) -> bytes:
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class ExportWriter:
+    """Base class for the export formats, subclasses write one chunk of rows at a time."""
+
+    def __init__(self, fp: typing.BinaryIO, header: list[str], new_file: bool):
+        self._fp = fp
+        self._header = header
+        if new_file:
+            self._write_header()
+
+    def _write_header(self):
+        """Can be defined in subclasses."""
+
+    def write_chunk(self, rows: list[tuple]):
+        raise NotImplementedError
+
+    def flush(self):
+        self._fp.flush()
+
+
+class CSVExportWriter(ExportWriter):
+    def __init__(self, fp, header, new_file):
+        self._text = io.TextIOWrapper(fp, encoding='utf-8', newline='', write_through=True)
+        self._csv = csv.writer(self._text)
+        super().__init__(fp, header, new_file)
+
+    def _write_header(self):
+        self._csv.writerow(self._header)
+
+    def write_chunk(self, rows):
+        self._csv.writerows(rows)
+
+
+class JSONLExportWriter(ExportWriter):
+    def write_chunk(self, rows):
+        header = self._header
+        self._fp.write(''.join(
+            json.dumps(dict(zip(header, row)), separators=(',', ':')) + '\n' for row in rows
+        ).encode('utf-8'))
+
+
+class ColumnarExportWriter(ExportWriter):
+    def _write_header(self):
+        out = [COL_MAGIC, struct.pack('<H', len(self._header))]
+        for name in self._header:
+            encoded = name.encode('utf-8')
+            out.append(struct.pack('<H', len(encoded)) + encoded)
+        self._fp.write(b''.join(out))
+
+    def write_chunk(self, rows):
+        out = [struct.pack('<I', len(rows))]
+        for col in zip(*rows):
+            nulls = bytearray((len(col) + 7) // 8)
+            for idx, val in enumerate(col):
+                if val is None:
+                    nulls[idx >> 3] |= 1 << (idx & 7)
+            values = [val for val in col if val is not None]
+            if all(type(val) is int for val in values):
+                out += [struct.pack('<B', COL_INT), nulls, le_bytes(array.array('q', values))]
+            else:
+                encoded = [str(val).encode('utf-8') for val in values]
+                out += [struct.pack('<B', COL_TEXT), nulls,
+                        le_bytes(array.array('I', map(len, encoded))), b''.join(encoded)]
+        self._fp.write(b''.join(out))
+
+
+FORMATS: dict[str, type[ExportWriter]] = {
+    'csv': CSVExportWriter,
+    'jsonl': JSONLExportWriter,
+    'col': ColumnarExportWriter,
+}
+
+
+def progress_path(path: str) -> str:
+    """The file storing the last exported id of an export, and the size of the file at that point"""
+    return path + '.progress'
+
+
+def read_progress(path: str) -> tuple[int, int | None] | None:
+    try:
+        with open(progress_path(path), 'r', encoding='utf-8') as f:
+            last_id, *size = map(int, f.read().split())
+    except (FileNotFoundError, ValueError):
+        return None
+    return last_id, size[0] if size else None
+
+
+def write_progress(path: str, last_id: int, size: int):
+    tmp = progress_path(path) + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(f'{last_id} {size}')
+    os.replace(tmp, progress_path(path))
+
+
+def export_catalogue(con: sqlite3.Connection, path: str, fmt: str = 'csv',
+                     compression: str | None = None, after_id: int | None = None,
+                     file_size: int | None = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Stream the joined GPU catalogue to a file in chunks, in ascending id order.
+
+    :param con: The database connection
+    :param path: The output file, appended to if after_id is given
+    :param fmt: One of the keys of FORMATS
+    :param compression: One of the keys of COMPRESSORS
+    :param after_id: Only export GPUs with a greater id, None to start a new export
+    :param file_size: The size of the file when after_id was exported, anything after it is cut off
+    :param chunk_size: The number of rows fetched and written at a time
+    :return: The number of rows exported
+
+    A resumed export cuts off what a killed one wrote after its progress, and appends more compressed streams:
+
+    >>> import tempfile
+    >>> from app.setup import reg_arch, reg_gpu, reg_manufacturer, reg_proc, reg_series, setup_table
+    >>> con = sqlite3.connect(':memory:')
+    >>> setup_table(con)
+    >>> proc_id, series_id = reg_proc(con, 'P', reg_arch(con, 'A')), reg_series(con, 'S', 2020)
+    >>> manufacturer_id = reg_manufacturer(con, 'M', 1990)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'gpus.csv.gz')
+    >>> [reg_gpu(con, name, proc_id, 1000, series_id, manufacturer_id, 8, 10000) for name in ('G1', 'G2')]
+    [1, 2]
+    >>> export_catalogue(con, path, compression='gzip', chunk_size=1)
+    2
+    >>> _ = reg_gpu(con, 'G3', proc_id, 1000, series_id, manufacturer_id, 8, 10000)
+    >>> with open(path, 'ab') as f:
+    ...     _ = f.write(b'half a chunk')
+    >>> after_id, file_size = read_progress(path)
+    >>> export_catalogue(con, path, compression='gzip', after_id=after_id, file_size=file_size)
+    1
+    >>> with open(path, 'rb') as raw, DECOMPRESSORS['gzip'](raw) as f:
+    ...     [line.split(',')[:2] for line in f.read().decode('utf-8').splitlines()]
+    [['id', 'name'], ['1', 'G1'], ['2', 'G2'], ['3', 'G3']]
+    """
+    writer_cls = FORMATS[fmt]
+    compressor = COMPRESSORS[compression]
+    templ = SELECT_GPU_DETAILS_WITH_ID_TEMPL
+    if after_id is not None:
+        templ = templ.where(r'GPU.id', operator.gt, after_id)
+    cursor = templ.order_by(r'GPU.id', is_asc=True).execute_on_dbcon(con)
+    header = get_header_from_cursor(cursor)
+    id_idx = header.index(ID_COLUMN)
+    resume = after_id is not None and os.path.exists(path)
+    count = 0
+    # the writer fills a buffer that is compressed and written out once per chunk
+    buf = io.BytesIO()
+    writer = writer_cls(buf, header, not resume)
+    with open(path, 'r+b' if resume else 'wb', buffering=WRITE_BUFFER_SIZE) as raw:
+        if resume and file_size is not None:
+            # drop whatever a killed export wrote after its last saved progress
+            raw.truncate(file_size)
+        raw.seek(0, os.SEEK_END)
+
+        def write_buffered():
+            writer.flush()
+            raw.write(compressor(buf.getvalue()))
+            buf.seek(0)
+            buf.truncate()
+
+        for rows in fetch_chunks_from_cursor(cursor, chunk_size):
+            writer.write_chunk(rows)
+            count += len(rows)
+            write_buffered()
+            raw.flush()
+            write_progress(path, rows[-1][id_idx], raw.tell())
+        if buf.tell():
+            # the header of an export without rows
+            write_buffered()
+    return count
+
+
+def read_columnar(path: str, compression: str | None = None) -> typing.Iterator[dict[str, list]]:
+    """Read back a columnar export, yields one dict of column lists per chunk"""
+    with open(path, 'rb', buffering=WRITE_BUFFER_SIZE) as raw, DECOMPRESSORS[compression](raw) as fp:
+        def read_exact(size: int) -> bytes:
+            data = fp.read(size)
+            if len(data) != size:
+                raise EOFError(f'Truncated columnar file: {path}')
+            return data
+
+        if read_exact(len(COL_MAGIC)) != COL_MAGIC:
+            raise ValueError(f'Not a columnar export: {path}')
+        header = []
+        for _ in range(struct.unpack('<H', read_exact(2))[0]):
+            header.append(read_exact(struct.unpack('<H', read_exact(2))[0]).decode('utf-8'))
+        while size_bytes := fp.read(4):
+            rows = struct.unpack('<I', size_bytes)[0]
+            chunk = {}
+            for name in header:
+                tag = read_exact(1)[0]
+                nulls = read_exact((rows + 7) // 8)
+                non_null = rows - sum(bin(b).count('1') for b in nulls)
+                values = array.array('q' if tag == COL_INT else 'I')
+                values.frombytes(read_exact(non_null * values.itemsize))
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                if tag == COL_TEXT:
+                    data = read_exact(sum(values))
+                    offsets, values = 0, list(values)
+                    for idx, length in enumerate(values):
+                        values[idx] = data[offsets:offsets + length].decode('utf-8')
+                        offsets += length
+                it = iter(values)
+                chunk[name] = [None if nulls[idx >> 3] & (1 << (idx & 7)) else next(it) for idx in range(rows)]
+            yield chunk
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog='python -m app.export', description='Export the GPU catalogue')
+    parser.add_argument('output', help='the file to export to')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--compress', choices=[k for k in COMPRESSORS if k], default=None)
+    parser.add_argument('--resume', action='store_true',
+                        help='append the GPUs after the last exported id of a previous export')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    after_id, file_size = (read_progress(args.output) if args.resume else None) or (None, None)
+    with connect(DB_PATH) as con:
+        count = export_catalogue(con, args.output, args.format, args.compress, after_id, file_size, args.chunk_size)
+    print(f'Exported {count} GPUs to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+Faceted filtering of the GPU list.
+
+The GPUs are counted per combination of facet values by one grouped query, and the counts of
+every facet for any filter are computed from these combinations in a single vectorized pass,
+without going back to the database. Both are cached until the ChangeLog moves on.
+"""
+from __future__ import annotations
+import collections
+import operator
+import sqlite3
+import threading
+import typing
+import urllib.parse
+
+import numpy as np
+
+from .db_utils import SQL_SelectTempl, fetch_chunks_from_cursor
+from .dim_cache import DIM_CACHE
+from .metrics import register_cache
+from .shards import change_log_position
+from .sql_statements import (
+    ARCH_OF_GPU_SQL,
+    PRICE_BAND_EDGES_CENTS,
+    PRICE_BAND_SQL,
+    SELECT_FACET_COUNTS_GROUP_BY,
+    SELECT_FACET_COUNTS_TEMPL,
+    VRAM_BUCKET_EDGES_GB,
+    VRAM_BUCKET_SQL,
+)
+
+# in the order of the columns of SELECT_FACET_COUNTS_TEMPL
+FACETS = ('manufacturer', 'arch', 'series', 'vram', 'price')
+FACET_TITLES = {
+    'manufacturer': 'Manufacturer',
+    'arch': 'Architecture',
+    'series': 'Series',
+    'vram': 'VRAM Size',
+    'price': 'Price',
+}
+# facet -> (dimension table, name column) of the facets over dimension rows
+FACET_DIMENSIONS = {
+    'manufacturer': ('Manufacturer', 'manufacturer_name'),
+    'arch': ('Architecture', 'arch_name'),
+    'series': ('Series', 'series_name'),
+}
+FACET_COLUMNS = {
+    'manufacturer': r'GPU.manufacturer_id',
+    'arch': ARCH_OF_GPU_SQL,
+    'series': r'GPU.series_id',
+    'vram': VRAM_BUCKET_SQL,
+    'price': PRICE_BAND_SQL,
+}
+MAX_CACHED_FILTERS = 1024
+FETCH_ROWS = 10000
+# stands for NULL in the arrays
+NO_VALUE = -1
+
+# facet -> the selected values, a GPU matches if it has one of the values of every facet
+Filters = dict[str, frozenset[int]]
+
+
+def _bucket_labels(edges: tuple[int, ...], fmt: typing.Callable[[int], str]) -> list[str]:
+    return [
+        f'under {fmt(edges[0])}',
+        *(f'{fmt(lo)} to under {fmt(hi)}' for lo, hi in zip(edges, edges[1:])),
+        f'{fmt(edges[-1])} and over',
+    ]
+
+
+BUCKET_LABELS = {
+    'vram': _bucket_labels(VRAM_BUCKET_EDGES_GB, lambda gb: f'{gb} GB'),
+    'price': _bucket_labels(PRICE_BAND_EDGES_CENTS, lambda cents: f'${cents // 100:,}'),
+}
+
+
+def filters_query(filters: Filters) -> str:
+    """The query string of the index page for a filter"""
+    return urllib.parse.urlencode([(facet, value) for facet in FACETS for value in sorted(filters.get(facet, ()))])
+
+
+def toggle_filter(filters: Filters, facet: str, value: int) -> Filters:
+    """The filter with a value selected if it was not, or unselected if it was"""
+    return {**filters, facet: filters.get(facet, frozenset()) ^ {value}}
+
+
+def where_filters(templ: SQL_SelectTempl, filters: Filters) -> SQL_SelectTempl:
+    """Add the conditions of a filter to a template selecting from the GPU table"""
+    for facet in FACETS:
+        values = sorted(filters.get(facet, ()))
+        if values:
+            templ = templ.where(FACET_COLUMNS[facet], operator.contains, values)
+    return templ
+
+
+class FacetCounter:
+    """
+    Thread-safe facet counts, cached per filter.
+
+    The count of a value is the number of GPUs the filter would match with that value
+    as the only selected value of its facet, so the other values of a facet stay visible.
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHED_FILTERS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # held while loading, so that concurrent refreshes load the combinations once
+        self._load_lock = threading.Lock()
+        self._seq: tuple[int, ...] | None = None
+        # one row per combination of facet values, and the number of GPUs with it
+        self._keys = np.empty((0, len(FACETS)), np.int64)
+        self._gpus = np.empty(0, np.int64)
+        # per facet, its distinct values and the index of each row's value in them
+        self._values: list[np.ndarray] = []
+        self._inverse: list[np.ndarray] = []
+        self._counts: collections.OrderedDict[tuple, tuple[int, dict[str, dict[int, int]]]] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, con: sqlite3.Connection):
+        templ = SELECT_FACET_COUNTS_TEMPL
+        for col in SELECT_FACET_COUNTS_GROUP_BY:
+            templ = templ.group_by(col)
+        chunks = [np.array(chunk, np.float64)
+                  for chunk in fetch_chunks_from_cursor(templ.execute_on_dbcon(con), FETCH_ROWS)]
+        rows = np.concatenate(chunks) if chunks else np.empty((0, len(FACETS) + 1))
+        # NULL comes back as NaN
+        rows = np.nan_to_num(rows, nan=NO_VALUE).astype(np.int64)
+        keys, gpus = rows[:, :-1], rows[:, -1]
+        values, inverse = zip(*(np.unique(keys[:, idx], return_inverse=True) for idx in range(len(FACETS))))
+        return keys, gpus, list(values), list(inverse)
+
+    def refresh(self, con: sqlite3.Connection):
+        """Reload the combinations if anything was written since they were loaded"""
+        seq = change_log_position(con)
+        with self._lock:
+            if seq == self._seq:
+                return
+        with self._load_lock:
+            # another thread may have loaded them while this one waited
+            seq = change_log_position(con)
+            with self._lock:
+                if seq == self._seq:
+                    return
+            loaded = self._load(con)
+            with self._lock:
+                self._keys, self._gpus, self._values, self._inverse = loaded
+                self._seq = seq
+                self._counts.clear()
+
+    def counts(self, con: sqlite3.Connection, filters: Filters) -> tuple[int, dict[str, dict[int, int]]]:
+        """
+        Count the GPUs matching a filter, and the GPUs per value of every facet.
+
+        :return: The number of matching GPUs, and facet -> value -> number of GPUs (only values with GPUs)
+
+        The counts of a facet ignore the values selected in it, but not in the other facets:
+
+        >>> from app.setup import setup_table
+        >>> con = sqlite3.connect(':memory:')
+        >>> setup_table(con)
+        >>> _ = con.executemany('INSERT INTO GPU (name, manufacturer_id, vram_size_gb) VALUES (?, ?, ?)',
+        ...                     [('A', 1, 8), ('B', 1, 16), ('C', 2, 8)])
+        >>> total, counts = FacetCounter().counts(con, {'manufacturer': frozenset({1})})
+        >>> total, counts['manufacturer'], counts['vram']
+        (2, {1: 2, 2: 1}, {2: 1, 4: 1})
+        >>> total, counts = FacetCounter().counts(con, {'manufacturer': frozenset({1}), 'vram': frozenset({2})})
+        >>> total, counts['manufacturer'], counts['vram']
+        (1, {1: 1, 2: 1}, {2: 1, 4: 1})
+        """
+        self.refresh(con)
+        signature = tuple((facet, tuple(sorted(filters[facet]))) for facet in FACETS if filters.get(facet))
+        with self._lock:
+            cached = self._counts.get(signature)
+            if cached is not None:
+                self.hits += 1
+                self._counts.move_to_end(signature)
+                return cached
+            self.misses += 1
+            keys, gpus, values, inverse = self._keys, self._gpus, self._values, self._inverse
+
+        # a row counts for a facet if it matches the filters of all the other facets
+        matches = [np.ones(len(keys), bool) if not filters.get(facet)
+                   else np.isin(keys[:, idx], list(filters[facet]))
+                   for idx, facet in enumerate(FACETS)]
+        missed = len(FACETS) - np.sum(matches, axis=0)
+        total = int(gpus[missed == 0].sum())
+        counts = {}
+        for idx, facet in enumerate(FACETS):
+            rows = (missed == 0) | ((missed == 1) & ~matches[idx])
+            per_value = np.bincount(inverse[idx][rows], weights=gpus[rows], minlength=len(values[idx]))
+            counts[facet] = {int(value): int(count) for value, count in zip(values[idx], per_value)
+                             if count and value != NO_VALUE}
+        result = total, counts
+
+        with self._lock:
+            self._counts[signature] = result
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return result
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._counts)}
+
+    def invalidate(self):
+        with self._lock:
+            self._seq = None
+            self._counts.clear()
+
+
+def facet_options(con: sqlite3.Connection, filters: Filters) -> tuple[int, list[dict[str, typing.Any]]]:
+    """
+    The facets to show on the index page.
+
+    :return: The number of matching GPUs, and per facet its name, title and options. An option
+        has a value, label, count, whether it is selected, and the query string that toggles it.
+    """
+    total, counts = FACET_COUNTER.counts(con, filters)
+    facets = []
+    for facet in FACETS:
+        selected = filters.get(facet, frozenset())
+        options = []
+        for value in sorted(counts[facet].keys() | selected):
+            if facet in FACET_DIMENSIONS:
+                table, name_col = FACET_DIMENSIONS[facet]
+                row = DIM_CACHE.get(con, table, value)
+                label = str(value) if row is None else row[name_col]
+            elif 0 <= value < len(BUCKET_LABELS[facet]):
+                label = BUCKET_LABELS[facet][value]
+            else:
+                label = str(value)
+            options.append({
+                'value': value,
+                'label': label,
+                'count': counts[facet].get(value, 0),
+                'selected': value in selected,
+                'query': filters_query(toggle_filter(filters, facet, value)),
+            })
+        if facet in FACET_DIMENSIONS:
+            options.sort(key=lambda option: option['label'])
+        facets.append({'name': facet, 'title': FACET_TITLES[facet], 'options': options})
+    return total, facets
+
+
+FACET_COUNTER = FacetCounter()
+register_cache('facets', FACET_COUNTER.stats)
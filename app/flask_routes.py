@@ -1,25 +1,35 @@
 from __future__ import annotations
 
+import datetime
 import operator
+import time
 
-from flask import render_template, redirect
+from flask import Response, abort, current_app, g, jsonify, render_template, redirect, request, stream_template
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from flask import Flask
 
+from .changes import DEFAULT_LIMIT as CHANGES_DEFAULT_LIMIT, changes_since, parse_cursor
 from .db_utils import (
+    MAX_IN_LIST,
     get_connection,
     destroy_connection,
-    fetch_all_from_cursor,
-    fetch_many_from_cursor,
 )
-from .sql_statements import (
-    SELECT_ARCH_INFO,
-    SELECT_GET_GPU_DETAILS_TEMPL,
-    SELECT_GPU_DETAILS_WITH_ID_TEMPL,
-    SELECT_MANU_INFO,
-)
-from .utils import db_1res_to_dict, foreach_apply_db_header
+from .dim_cache import DIM_CACHE
+from .facets import FACETS, facet_options, where_filters
+from .metrics import CONTENT_TYPE, REGISTRY, REQUEST_LATENCY, REQUESTS
+from .price_history import RESOLUTIONS, price_buckets
+from .setup import upgrade_table
+from .similar import DEFAULT_K as SIMILAR_DEFAULT_K, SIMILAR_INDEX
+from .sql_statements import SELECT_GPU_ROWS_TEMPL
+
+MAX_CHANGES_LIMIT = 10000
+MAX_SIMILAR_K = 100
+
+
+def connection():
+    """The connection of this thread to the database of the app"""
+    return get_connection(current_app.config['DB_PATH'])
 
 
 def index():
@@ -27,56 +37,217 @@ def index():
 
 
 def index_html():
-    return render_template('/template.html', gpus=foreach_apply_db_header(
-        fetch_all_from_cursor(
-            SELECT_GPU_DETAILS_WITH_ID_TEMPL
-            .execute_on_dbcon(get_connection()))))
+    filters = {facet: frozenset(parse_id_list(request.args.getlist(facet))) for facet in FACETS}
+    filters = {facet: values for facet, values in filters.items() if values}
+    con = connection()
+    total, facets = facet_options(con, filters)
+    return stream_template(
+        '/template.html', total=total, facets=facets, filtered=bool(filters),
+        gpus=DIM_CACHE.iter_enrich_gpus(con, (
+            where_filters(SELECT_GPU_ROWS_TEMPL, filters)
+            .order_by(r'GPU.id', is_asc=True)
+            .execute_on_dbcon(con, lazy=True))))
 
 
 def gpu_info_page(gpu_id):
-    gpu_info = db_1res_to_dict(fetch_many_from_cursor(
-        SELECT_GET_GPU_DETAILS_TEMPL
-        .where(r'GPU.id', operator.eq, gpu_id)
-        .execute_on_dbcon(get_connection())))
+    con = connection()
+    gpu = SELECT_GPU_ROWS_TEMPL.where(r'GPU.id', operator.eq, gpu_id).execute_on_dbcon(con, lazy=True).first()
+    gpu = gpu and DIM_CACHE.enrich_gpu(con, gpu)
+    if gpu is None:
+        abort(404)
+    price_resolution, prices = price_buckets(con, gpu_id)
+    similar = SIMILAR_INDEX.similar(con, gpu_id) or []
     return render_template('gpu/template.html', **{
         'gpu_id': gpu_id,
-        'other_info': gpu_info,
+        'other_info': gpu,
+        'price_resolution': price_resolution,
+        'prices': prices,
+        'similar': select_gpus_by_ids(con, [similar_id for similar_id, _ in similar]),
+    })
+
+
+def parse_timestamp(raw: str | None) -> int | None:
+    """Parse a unix timestamp or an ISO 8601 date(time), naive ones are taken as UTC"""
+    if raw is None or not raw.strip():
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.datetime.fromisoformat(raw)
+    except ValueError:
+        abort(400)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+def api_gpu_prices(gpu_id):
+    resolution = request.args.get('resolution', 'auto')
+    if resolution != 'auto' and resolution not in RESOLUTIONS:
+        abort(400)
+    resolution, points = price_buckets(
+        connection(), gpu_id, resolution,
+        parse_timestamp(request.args.get('from')), parse_timestamp(request.args.get('to')))
+    return jsonify({
+        'gpu_id': gpu_id,
+        'resolution': resolution,
+        'points': points,
+    })
+
+
+def api_similar_gpus(gpu_id):
+    try:
+        k = int(request.args.get('k', SIMILAR_DEFAULT_K))
+        max_price = request.args.get('max_price')
+        max_price = None if max_price is None else int(max_price)
+    except ValueError:
+        abort(400)
+    if not 0 < k <= MAX_SIMILAR_K:
+        abort(400)
+    con = connection()
+    similar = SIMILAR_INDEX.similar(con, gpu_id, k, request.args.get('same_manufacturer') in ('1', 'true'), max_price)
+    if similar is None:
+        abort(404)
+    distances = dict(similar)
+    return jsonify({
+        'gpu_id': gpu_id,
+        'similar': [{**gpu, 'distance': distances[gpu['id']]}
+                    for gpu in select_gpus_by_ids(con, list(distances))],
+    })
+
+
+def api_changes():
+    try:
+        since = parse_cursor(request.args.get('since', '0'))
+        limit = int(request.args.get('limit', CHANGES_DEFAULT_LIMIT))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_CHANGES_LIMIT:
+        abort(400)
+    return jsonify(changes_since(connection(), since, limit))
+
+
+def parse_id_list(raw_ids: list[str]) -> list[int]:
+    """Parse `?ids=1,2&ids=3` into [1, 2, 3], dropping duplicates but keeping the order"""
+    ids: dict[int, None] = {}
+    for raw in raw_ids:
+        for part in raw.split(','):
+            if part.strip():
+                try:
+                    ids[int(part)] = None
+                except ValueError:
+                    abort(400)
+    return list(ids)
+
+
+def select_gpus_by_ids(con, gpu_ids: list[int]) -> list[dict]:
+    """
+    Fetch many GPUs with one IN-list query per MAX_IN_LIST ids, in the order of gpu_ids.
+    Ids that do not exist are left out.
+    """
+    gpus = {}
+    for start in range(0, len(gpu_ids), MAX_IN_LIST):
+        for gpu in DIM_CACHE.iter_enrich_gpus(con, (
+                SELECT_GPU_ROWS_TEMPL
+                .where(r'GPU.id', operator.contains, gpu_ids[start:start + MAX_IN_LIST])
+                .execute_on_dbcon(con, lazy=True))):
+            gpus[gpu['id']] = gpu
+    return [gpus[gpu_id] for gpu_id in gpu_ids if gpu_id in gpus]
+
+
+def gpu_compare_page():
+    gpu_ids = parse_id_list(request.args.getlist('ids'))
+    return render_template('gpu/compare.html', gpus=select_gpus_by_ids(connection(), gpu_ids))
+
+
+def api_gpus():
+    gpu_ids = parse_id_list(request.args.getlist('ids'))
+    gpus = select_gpus_by_ids(connection(), gpu_ids)
+    found = {gpu['id'] for gpu in gpus}
+    return jsonify({
+        'gpus': gpus,
+        'missing': [gpu_id for gpu_id in gpu_ids if gpu_id not in found],
     })
 
 
 def manufacturer_info(manu_id):
-    con = get_connection()
-    manu_info = db_1res_to_dict(fetch_many_from_cursor(
-        SELECT_MANU_INFO
-        .where(r'Manufacturer.manufacturer_id', operator.eq, manu_id)
-        .execute_on_dbcon(con)))
-    return render_template('manufacturer/template.html', **manu_info, gpus=(
-        foreach_apply_db_header(fetch_all_from_cursor(
-            SELECT_GPU_DETAILS_WITH_ID_TEMPL
-            .where(r'Manufacturer.manufacturer_id', operator.eq, manu_id)
-            .execute_on_dbcon(con)))))
+    con = connection()
+    manu_info = DIM_CACHE.get(con, 'Manufacturer', manu_id)
+    if manu_info is None:
+        abort(404)
+    return stream_template('manufacturer/template.html', **manu_info, gpus=(
+        DIM_CACHE.iter_enrich_gpus(con, (
+            SELECT_GPU_ROWS_TEMPL
+            .where(r'GPU.manufacturer_id', operator.eq, manu_id)
+            .order_by(r'GPU.id', is_asc=True)
+            .execute_on_dbcon(con, lazy=True)))))
 
 
 def arch_info(arch_id):
-    con = get_connection()
-    select_arch = (r'Architecture.arch_id', operator.eq, arch_id)
-    arch_info = db_1res_to_dict(fetch_many_from_cursor(
-        SELECT_ARCH_INFO
-        .where(*select_arch)
-        .execute_on_dbcon(con)))
-    return render_template('arch/template.html', **arch_info, gpus=(
-        foreach_apply_db_header(fetch_all_from_cursor(
-            SELECT_GPU_DETAILS_WITH_ID_TEMPL
-            .where(*select_arch)
-            .execute_on_dbcon(con)
-        ))))
-
-
-def setup_flask_app(app: Flask):
+    con = connection()
+    arch_info = DIM_CACHE.get(con, 'Architecture', arch_id)
+    if arch_info is None:
+        abort(404)
+    proc_ids = [proc['proc_id'] for proc in DIM_CACHE.find(con, 'Processor', 'arch_id', arch_id)]
+    return stream_template('arch/template.html', **arch_info, gpus=(
+        DIM_CACHE.iter_enrich_gpus(con, (
+            SELECT_GPU_ROWS_TEMPL
+            .where(r'GPU.proc_id', operator.contains, proc_ids)
+            .order_by(r'GPU.id', is_asc=True)
+            .execute_on_dbcon(con, lazy=True)))))
+
+
+def metrics_page():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+def refresh_dimension_cache():
+    # picks up the dimension rows written by other processes, e.g. the CLI
+    if request.endpoint not in ('static', 'metrics_page'):
+        DIM_CACHE.refresh(connection())
+
+
+def observe_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        method, status = request.method, response.status_code
+
+        # streamed pages are still rendering here, so observe once the body was sent
+        def observe():
+            REQUEST_LATENCY.observe(time.perf_counter() - start, route, method)
+            REQUESTS.inc(route, method, status)
+        response.call_on_close(observe)
+    return response
+
+
+def setup_flask_app(app: Flask, db_path: str | None = None):
+    """
+    :param db_path: The database file to serve, None for DB_PATH
+    """
+    app.config['DB_PATH'] = db_path
+    upgrade_table(get_connection(db_path))
+    get_connection(db_path).commit()
+    destroy_connection()
     app.route('/')(index)
     app.route('/index.html')(index_html)
     app.route('/gpu/<int:gpu_id>')(gpu_info_page)
+    app.route('/gpu/compare')(gpu_compare_page)
+    app.route('/api/gpus')(api_gpus)
+    app.route('/api/gpu/<int:gpu_id>/prices')(api_gpu_prices)
+    app.route('/api/gpu/<int:gpu_id>/similar')(api_similar_gpus)
+    app.route('/api/changes')(api_changes)
     app.route('/manufacturer/<int:manu_id>')(manufacturer_info)
     app.route('/arch/<int:arch_id>')(arch_info)
+    app.route('/metrics')(metrics_page)
+    app.before_request(start_request_timer)
+    app.before_request(refresh_dimension_cache)
+    app.after_request(observe_request)
     app.teardown_appcontext(lambda *_, **__: destroy_connection())
     return app
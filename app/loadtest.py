@@ -0,0 +1,330 @@
+"""
+Load generator for the routes from setup_flask_app.
+
+Usage: python -m app.loadtest [--mode client|server|url] [--concurrency N | --rate RPS] [--duration S] ...
+
+Modes:
+    client  drive the app in-process through the Flask test client
+    server  start the app on a local port and send real HTTP requests to it
+    url     send HTTP requests to an already running server at --url
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import itertools
+import logging
+import os.path
+import random
+import sqlite3
+import threading
+import time
+import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass
+
+from . import db_utils
+from .dim_cache import DIM_CACHE
+from .setup import setup_table
+from .similar import SIMILAR_INDEX
+from .sql_statements import (
+    INSERT_ARCH_STATEMENT,
+    INSERT_GPU_STATEMENT,
+    INSERT_MANU_STATEMENT,
+    INSERT_PROC_STATEMENT,
+    INSERT_SERIES_STATEMENT,
+)
+from .utils import fmt_table
+
+DEFAULT_MIX = {'index': 1, 'gpu': 6, 'manufacturer': 2, 'arch': 2}
+PERCENTILES = (50, 95, 99)
+
+# route name -> (path template, table and id column to sample ids from)
+ROUTES: dict[str, tuple[str, tuple[str, str] | None]] = {
+    'index': ('/index.html', None),
+    'gpu': ('/gpu/{}', ('GPU', 'id')),
+    'manufacturer': ('/manufacturer/{}', ('Manufacturer', 'manufacturer_id')),
+    'arch': ('/arch/{}', ('Architecture', 'arch_id')),
+}
+
+
+@dataclass
+class Result:
+    route: str
+    status: int
+    latency: float
+
+
+class RequestMix:
+    """Picks the next request path according to the route weights"""
+
+    def __init__(self, weights: dict[str, float], ids: dict[str, list[int]], seed: int | None = None):
+        self._routes = [route for route, weight in weights.items() if weight > 0]
+        self._cum_weights = list(itertools.accumulate(weights[route] for route in self._routes))
+        self._ids = ids
+        self._seed = seed
+
+    def rng(self, worker: int) -> random.Random:
+        return random.Random(None if self._seed is None else self._seed + worker)
+
+    def next(self, rng: random.Random) -> tuple[str, str]:
+        route = rng.choices(self._routes, cum_weights=self._cum_weights)[0]
+        templ, id_source = ROUTES[route]
+        if id_source is None:
+            return route, templ
+        return route, templ.format(rng.choice(self._ids[route]))
+
+
+def load_ids(con: sqlite3.Connection, routes: typing.Iterable[str]) -> dict[str, list[int]]:
+    """Get the ids the requests can use, from the tables behind the routes"""
+    ids = {}
+    for route in routes:
+        id_source = ROUTES[route][1]
+        if id_source is not None:
+            table, col = id_source
+            ids[route] = [row[0] for row in db_utils.exec_statement(con, f'SELECT {col} FROM {table};')]
+            if not ids[route]:
+                raise ValueError(f'Table {table} is empty, cannot request {route} pages')
+    return ids
+
+
+def generate_synthetic_db(path: str, gpus: int, seed: int = 0):
+    """Create a database with the given number of random GPUs and proportionally many dimension rows"""
+    rng = random.Random(seed)
+    n_manu = max(gpus // 1000, 5)
+    n_arch = max(gpus // 500, 5)
+    n_proc = max(gpus // 50, 10)
+    n_series = max(gpus // 200, 5)
+    with sqlite3.connect(path) as con:
+        setup_table(con)
+        con.executemany(INSERT_MANU_STATEMENT,
+                        ((f'Manufacturer {i}', rng.randint(1950, 2020)) for i in range(n_manu)))
+        con.executemany(INSERT_ARCH_STATEMENT, ((f'Architecture {i}',) for i in range(n_arch)))
+        con.executemany(INSERT_PROC_STATEMENT,
+                        ((f'Processor {i}', rng.randint(1, n_arch)) for i in range(n_proc)))
+        con.executemany(INSERT_SERIES_STATEMENT,
+                        ((f'Series {i}', rng.randint(1990, 2025)) for i in range(n_series)))
+        con.executemany(INSERT_GPU_STATEMENT, (
+            (f'GPU {i}', rng.randint(1, n_proc), rng.randint(500, 3000), rng.randint(1, n_series),
+             rng.randint(1, n_manu), rng.choice((2, 4, 6, 8, 12, 16, 24, 32, 48)), rng.randint(5000, 300000))
+            for i in range(gpus)))
+        con.commit()
+
+
+def make_client_sender(app) -> typing.Callable[[], typing.Callable[[str], int]]:
+    def factory():
+        client = app.test_client()
+
+        def send(path: str) -> int:
+            # streamed pages only render as the body is read
+            with client.get(path) as resp:
+                resp.get_data()
+                return resp.status_code
+        return send
+    return factory
+
+
+def make_http_sender(base_url: str) -> typing.Callable[[], typing.Callable[[str], int]]:
+    def factory():
+        def send(path: str) -> int:
+            try:
+                with urllib.request.urlopen(base_url + path) as resp:
+                    resp.read()
+                    return resp.status
+            except urllib.error.HTTPError as e:
+                return e.code
+        return send
+    return factory
+
+
+def run_threads(sender_factory, mix: RequestMix, concurrency: int, duration: float,
+                rate: float | None = None) -> list[Result]:
+    """
+    Send requests from concurrency threads for duration seconds.
+
+    :param rate: None to send back to back (closed loop), or the total requests per second to schedule
+        (open loop). In open loop latencies are measured from when a request was due, so a slow server
+        is not hidden by the workers falling behind.
+    """
+    results: list[Result] = []
+    seq = itertools.count()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker(worker_idx: int):
+        send = sender_factory()
+        rng = mix.rng(worker_idx)
+        local: list[Result] = []
+        while True:
+            if rate is None:
+                due = time.perf_counter()
+            else:
+                due = start + next(seq) / rate
+                if due > time.perf_counter():
+                    time.sleep(due - time.perf_counter())
+            if due >= deadline:
+                break
+            route, path = mix.next(rng)
+            try:
+                status = send(path)
+            except Exception:
+                status = 0
+            local.append(Result(route, status, time.perf_counter() - due))
+        results.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(idx,), daemon=True) for idx in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+async def _async_get(host: str, port: int, path: str) -> int:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nConnection: close\r\n\r\n'.encode('ascii'))
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()  # the server closes the connection after the body
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+def run_asyncio(base_url: str, mix: RequestMix, concurrency: int, duration: float,
+                rate: float | None = None) -> list[Result]:
+    """Same as run_threads, but with asyncio tasks sending plain HTTP/1.1 requests"""
+    url = urllib.parse.urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+
+    async def main() -> list[Result]:
+        results: list[Result] = []
+        seq = itertools.count()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + duration
+
+        async def worker(worker_idx: int):
+            rng = mix.rng(worker_idx)
+            while True:
+                if rate is None:
+                    due = loop.time()
+                else:
+                    due = start + next(seq) / rate
+                    await asyncio.sleep(max(due - loop.time(), 0))
+                if due >= deadline:
+                    break
+                route, path = mix.next(rng)
+                try:
+                    status = await _async_get(host, port, url.path.rstrip('/') + path)
+                except (OSError, ValueError, IndexError):
+                    status = 0
+                results.append(Result(route, status, loop.time() - due))
+
+        await asyncio.gather(*(worker(idx) for idx in range(concurrency)))
+        return results
+
+    return asyncio.run(main())
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return float('nan')
+    rank = max(int(-(-p * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def report(results: list[Result], elapsed: float) -> str:
+    """Format the throughput and latency percentiles, overall and per route"""
+    groups: dict[str, list[Result]] = {'all': results}
+    for result in results:
+        groups.setdefault(result.route, []).append(result)
+    table: list[tuple] = [('route', 'requests', 'errors', 'req/s', *(f'p{p} (ms)' for p in PERCENTILES), 'max (ms)')]
+    for route, group in groups.items():
+        latencies = sorted(result.latency for result in group)
+        errors = sum(1 for result in group if not 200 <= result.status < 400)
+        table.append((
+            route, len(group), errors, f'{len(group) / elapsed:.1f}',
+            *(f'{percentile(latencies, p) * 1000:.2f}' for p in PERCENTILES),
+            f'{latencies[-1] * 1000:.2f}' if latencies else 'nan',
+        ))
+    return fmt_table(table, align_to=str.rjust)
+
+
+def parse_mix(raw: str) -> dict[str, float]:
+    """Parse `gpu=6,index=1` into route weights"""
+    weights = {route: 0.0 for route in ROUTES}
+    for part in raw.split(','):
+        route, _, weight = part.partition('=')
+        if route.strip() not in ROUTES:
+            raise argparse.ArgumentTypeError(f'Unknown route {route!r}, expected one of {", ".join(ROUTES)}')
+        weights[route.strip()] = float(weight or 1)
+    return weights
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog='python -m app.loadtest', description='Load test the GPU DB app')
+    parser.add_argument('--mode', choices=('client', 'server', 'url'), default='client')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='the server to test in url mode')
+    parser.add_argument('--workers', choices=('thread', 'asyncio'), default='thread',
+                        help='asyncio workers need the server or url mode')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='total requests per second, default is to send back to back')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--mix', type=parse_mix, default=dict(DEFAULT_MIX),
+                        help='route weights, e.g. index=1,gpu=6,manufacturer=2,arch=2')
+    parser.add_argument('--db', default=None, help='use this database instead of DB_PATH (client and server modes)')
+    parser.add_argument('--synthesize', type=int, default=None, metavar='GPUS',
+                        help='create --db with this many random GPUs if it does not exist')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.workers == 'asyncio' and args.mode == 'client':
+        parser.error('asyncio workers need --mode server or url')
+    if args.synthesize is not None:
+        if args.db is None:
+            parser.error('--synthesize needs --db')
+        if not os.path.exists(args.db):
+            print(f'Generating {args.synthesize} GPUs in {args.db}')
+            generate_synthetic_db(args.db, args.synthesize, 0 if args.seed is None else args.seed)
+    if args.db is not None:
+        DIM_CACHE.invalidate()
+        SIMILAR_INDEX.invalidate()
+
+    with db_utils.connect(args.db) as con:
+        mix = RequestMix(args.mix, load_ids(con, [route for route, weight in args.mix.items() if weight > 0]),
+                         args.seed)
+
+    server = None
+    if args.mode in ('client', 'server'):
+        from flask import Flask
+        from .flask_routes import setup_flask_app
+        app = setup_flask_app(Flask('app'), args.db)
+    if args.mode == 'server':
+        from werkzeug.serving import make_server
+        # the per request access log would cost more than some of the requests
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = f'http://127.0.0.1:{server.server_port}'
+
+    try:
+        start = time.perf_counter()
+        if args.workers == 'asyncio':
+            results = run_asyncio(args.url, mix, args.concurrency, args.duration, args.rate)
+        else:
+            factory = make_client_sender(app) if args.mode == 'client' else make_http_sender(args.url)
+            results = run_threads(factory, mix, args.concurrency, args.duration, args.rate)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+    print(report(results, elapsed), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+In-process metrics exposed in the Prometheus text format.
+
+The collectors keep one shard of values per thread, so recording a sample
+never takes a lock. The shards are only summed up when /metrics is scraped.
+"""
+from __future__ import annotations
+import bisect
+import functools
+import re
+import threading
+import typing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+# the first keywords of the statements that get a label of their own
+LABELLED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+# (name, type, help, [(labels, value)])
+MetricFamily = tuple[str, str, str, list[tuple[dict[str, str], float]]]
+
+
+class _ThreadShards:
+    """
+    Per-thread dicts, only the owning thread writes to its shard.
+
+    Servers that start a thread per request would leave a shard behind for every
+    request, so the shards of finished threads are folded into a single one with merge().
+    """
+
+    def __init__(self, merge: typing.Callable[[dict, dict], None]):
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: list[tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+
+    def local(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """Fold the shards of finished threads, must hold the lock"""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            self._retire()
+            shards = [self._retired, *(shard for _, shard in self._shards)]
+            # dict.copy() does not release the GIL, so it never sees a half-done update
+            return [shard.copy() for shard in shards]
+
+
+class Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, help_: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+        self._shards = _ThreadShards(self._merge)
+
+    @staticmethod
+    def _merge(into: dict, shard: dict):
+        raise NotImplementedError
+
+    def _labels(self, labelvalues: tuple) -> dict[str, str]:
+        return dict(zip(self.labelnames, map(str, labelvalues)))
+
+    def collect(self) -> list[MetricFamily]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1):
+        shard = self._shards.local()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, val in shard.items():
+            into[key] = into.get(key, 0) + val
+
+    def values(self) -> dict[tuple, float]:
+        merged: dict[tuple, float] = {}
+        for shard in self._shards.snapshot():
+            self._merge(merged, shard)
+        return merged
+
+    def collect(self):
+        return [(self.name, self.TYPE, self.help,
+                 [(self._labels(key), val) for key, val in sorted(self.values().items())])]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_, labelnames=(), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        shard = self._shards.local()
+        # per bucket counts (the last one is +Inf), then the sum
+        data = shard.get(labelvalues)
+        if data is None:
+            data = shard[labelvalues] = [0] * (len(self.buckets) + 2)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, data in shard.items():
+            data = list(data)
+            into[key] = [a + b for a, b in zip(into[key], data)] if key in into else data
+
+    def collect(self):
+        merged: dict[tuple, list] = {}
+        for shard in self._shards.snapshot():
+            self._merge(merged, shard)
+        samples = []
+        for key, data in sorted(merged.items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), data):
+                cumulative += count
+                samples.append(({**labels, 'le': fmt_value(bound)}, cumulative))
+            samples.append(({**labels, '__suffix__': '_sum'}, data[-1]))
+            samples.append(({**labels, '__suffix__': '_count'}, cumulative))
+        return [(self.name, self.TYPE, self.help, samples)]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: list[Metric] = []
+        self._collectors: list[typing.Callable[[], list[MetricFamily]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: typing.Callable[[], list[MetricFamily]]):
+        """Register a function called on every scrape, for values kept elsewhere (e.g. cache statistics)"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> list[MetricFamily]:
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors)
+        families = []
+        for metric in metrics:
+            families += metric.collect()
+        for collector in collectors:
+            families += collector()
+        return families
+
+    def render(self) -> str:
+        """Render all the metrics in the Prometheus text format"""
+        # merge the families of the same name, e.g. the stats of several caches
+        families: dict[str, MetricFamily] = {}
+        for name, type_, help_, samples in self.collect():
+            if name in families:
+                families[name][3].extend(samples)
+            else:
+                families[name] = (name, type_, help_, list(samples))
+        out = []
+        for name, type_, help_, samples in families.values():
+            out.append(f'# HELP {name} {help_}\n# TYPE {name} {type_}\n')
+            for labels, value in samples:
+                labels = dict(labels)
+                sample_name = name + labels.pop('__suffix__', '_bucket' if 'le' in labels else '')
+                label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                out.append(f'{sample_name}{{{label_str}}} {fmt_value(value)}\n' if label_str
+                           else f'{sample_name} {fmt_value(value)}\n')
+        return ''.join(out)
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def fmt_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(statement: str) -> str:
+    """
+    A short, low cardinality label for a SQL statement.
+    Statements other than SELECT, INSERT, UPDATE and DELETE (DDL, PRAGMA, ...) are all labelled 'other'.
+
+    >>> statement_label('SELECT id, name FROM GPU WHERE id IN (?, ?, ?);')
+    'SELECT ... FROM GPU WHERE id IN (?, ...);'
+    >>> statement_label('CREATE TABLE IF NOT EXISTS "gpu_shard0"."GPU" (id INTEGER PRIMARY KEY);')
+    'other'
+    """
+    statement = ' '.join(statement.split())
+    if statement.split(' ', 1)[0].upper() not in LABELLED_STATEMENTS:
+        return 'other'
+    # the select list is long and rarely tells statements apart, the FROM and WHERE clauses do
+    statement = re.sub(r'^SELECT .*? FROM ', 'SELECT ... FROM ', statement, flags=re.IGNORECASE)
+    # IN lists of any length get the same label
+    statement = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', statement)
+    return statement if len(statement) <= 200 else statement[:197] + '...'
+
+
+def register_cache(name: str, stats: typing.Callable[[], dict[str, int]]):
+    """
+    Export the statistics of a cache.
+
+    :param name: The value of the cache label
+    :param stats: A function returning a dict with the hits, misses and entries of the cache
+    """
+    def collector() -> list[MetricFamily]:
+        s = stats()
+        lookups = s['hits'] + s['misses']
+        labels = {'cache': name}
+        return [
+            ('cache_hits_total', 'counter', 'Cache lookups served from memory', [(labels, s['hits'])]),
+            ('cache_misses_total', 'counter', 'Cache lookups that went to the database', [(labels, s['misses'])]),
+            ('cache_hit_ratio', 'gauge', 'Hits divided by lookups since startup',
+             [(labels, s['hits'] / lookups if lookups else 0.0)]),
+            ('cache_entries', 'gauge', 'Entries currently cached', [(labels, s['entries'])]),
+        ]
+    REGISTRY.register_collector(collector)
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('route', 'method')))
+REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status', ('route', 'method', 'status')))
+STATEMENT_DURATION = REGISTRY.register(Histogram(
+    'db_statement_duration_seconds', 'SQL statement execution time, the count is the number of executions',
+    ('statement',)))
+ROWS_FETCHED = REGISTRY.register(Counter(
+    'db_rows_fetched_total', 'Rows fetched from cursors'))
+CONNECTIONS_OPENED = REGISTRY.register(Counter(
+    'db_connections_opened_total', 'Connections opened by get_connection'))
+CONNECTIONS_CLOSED = REGISTRY.register(Counter(
+    'db_connections_closed_total', 'Connections closed by destroy_connection'))
@@ -0,0 +1,92 @@
+"""Range queries and downsampling of the GPU price history."""
+from __future__ import annotations
+import datetime
+import operator
+import sqlite3
+import typing
+
+from .sql_statements import (
+    PRICE_BUCKET_SECONDS,
+    SELECT_PRICE_BUCKETS_TEMPLS,
+    SELECT_PRICE_HISTORY_TEMPL,
+)
+
+RESOLUTIONS = ('raw', *PRICE_BUCKET_SECONDS)
+# the auto resolution picks the finest buckets that keep a range under this many points
+MAX_AUTO_POINTS = 400
+
+
+def _where_range(templ, gpu_id: int, start: int | None, end: int | None):
+    templ = templ.where(r'gpu_id', operator.eq, gpu_id)
+    if start is not None:
+        templ = templ.where(r'recorded_at', operator.ge, start)
+    if end is not None:
+        templ = templ.where(r'recorded_at', operator.lt, end)
+    return templ
+
+
+def fmt_timestamp(ts: int) -> str:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).date().isoformat()
+
+
+def pick_resolution(start: int | None, end: int | None, first: int | None, last: int | None) -> str:
+    """
+    Pick the finest resolution that keeps the range under MAX_AUTO_POINTS points.
+
+    :param start: The start of the requested range, None for the first sample
+    :param end: The end of the requested range, None for the last sample
+    :param first: The timestamp of the first sample of the GPU, None if it has none
+    :param last: The timestamp of the last sample of the GPU, None if it has none
+    """
+    if first is None:
+        return 'raw'
+    span = (last + 1 if end is None else end) - (first if start is None else start)
+    for resolution, seconds in PRICE_BUCKET_SECONDS.items():
+        if span / seconds <= MAX_AUTO_POINTS:
+            return resolution
+    return list(PRICE_BUCKET_SECONDS)[-1]
+
+
+def price_range_bounds(con: sqlite3.Connection, gpu_id: int) -> tuple[int | None, int | None]:
+    """The timestamps of the first and last price samples of a GPU"""
+    first = _where_range(SELECT_PRICE_HISTORY_TEMPL, gpu_id, None, None).order_by(r'recorded_at', is_asc=True)
+    last = _where_range(SELECT_PRICE_HISTORY_TEMPL, gpu_id, None, None).order_by(r'recorded_at', is_asc=False)
+    # two index seeks instead of a MIN/MAX aggregate over the whole range
+    first_row = first.execute_on_dbcon(con).fetchone()
+    last_row = last.execute_on_dbcon(con).fetchone()
+    return (None if first_row is None else first_row[0]), (None if last_row is None else last_row[0])
+
+
+def price_range(con: sqlite3.Connection, gpu_id: int,
+                start: int | None = None, end: int | None = None) -> list[dict[str, typing.Any]]:
+    """Every price sample of a GPU with start <= recorded_at < end, oldest first"""
+    return list(
+        _where_range(SELECT_PRICE_HISTORY_TEMPL, gpu_id, start, end)
+        .order_by(r'recorded_at', is_asc=True)
+        .execute_on_dbcon(con, lazy=True))
+
+
+def price_buckets(con: sqlite3.Connection, gpu_id: int, resolution: str = 'auto',
+                  start: int | None = None, end: int | None = None) -> tuple[str, list[dict[str, typing.Any]]]:
+    """
+    Downsample the price history of a GPU into min/avg/max buckets, computed by the database.
+
+    :param resolution: One of RESOLUTIONS, or 'auto' to pick one with pick_resolution
+    :param start: Only include samples with recorded_at >= start
+    :param end: Only include samples with recorded_at < end
+    :return: The resolution used and the buckets (or samples for 'raw'), oldest first
+    """
+    if resolution == 'auto':
+        bounds = price_range_bounds(con, gpu_id)
+        resolution = pick_resolution(start, end, *bounds)
+    if resolution == 'raw':
+        points = price_range(con, gpu_id, start, end)
+    else:
+        points = list(
+            _where_range(SELECT_PRICE_BUCKETS_TEMPLS[resolution], gpu_id, start, end)
+            .group_by(r'bucket_start')
+            .order_by(r'bucket_start', is_asc=True)
+            .execute_on_dbcon(con, lazy=True))
+    for point in points:
+        point['date'] = fmt_timestamp(point['recorded_at' if resolution == 'raw' else 'bucket_start'])
+    return resolution, points
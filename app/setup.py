@@ -1,14 +1,26 @@
+from .changes import maybe_compact_change_log
 from .db_utils import exec_statements, exec_statement
+from .dim_cache import DIM_CACHE
+from .shards import append_shard_prices, attached_shards, insert_gpu, shard_for_manufacturer, shard_schema
 from .sql_statements import (
+    BACKFILL_CHANGE_LOG_STATEMENTS,
+    BACKFILL_PRICE_HISTORY_STATEMENT,
     CREATE_TABLE_STATEMENTS,
     INSERT_SERIES_STATEMENT,
     INSERT_ARCH_STATEMENT,
     INSERT_MANU_STATEMENT,
     INSERT_PROC_STATEMENT,
     INSERT_GPU_STATEMENT,
+    INSERT_PRICE_STATEMENT,
+    INSERT_SCHEMA_PRICE_TEMPL,
+    SELECT_CHANGE_LOG_EXISTS,
+    SELECT_PRICE_HISTORY_EXISTS,
+    UPDATE_GPU_LATEST_PRICE_STATEMENT,
+    UPGRADE_TABLE_STATEMENTS,
 )
 from .utils import current_year
 import sqlite3
+import time
 import typing
 
 
@@ -17,24 +29,47 @@ def setup_table(con: sqlite3.Connection) -> None:
     exec_statements(con, *CREATE_TABLE_STATEMENTS)
 
 
+def upgrade_table(con: sqlite3.Connection) -> None:
+    """Add the tables missing from a database set up by an older version"""
+    had_price_history = exec_statement(con, SELECT_PRICE_HISTORY_EXISTS).fetchone() is not None
+    had_change_log = exec_statement(con, SELECT_CHANGE_LOG_EXISTS).fetchone() is not None
+    exec_statements(con, *UPGRADE_TABLE_STATEMENTS)
+    if not had_price_history:
+        exec_statement(con, BACKFILL_PRICE_HISTORY_STATEMENT, (int(time.time()),))
+    if not had_change_log:
+        exec_statements(con, *BACKFILL_CHANGE_LOG_STATEMENTS)
+
+
 def reg_series(con: sqlite3.Connection, name: str, release_year: int = current_year()) -> int:
     """Register a new GPU series"""
-    return exec_statement(con, INSERT_SERIES_STATEMENT, (name, release_year)).lastrowid
+    rowid = exec_statement(con, INSERT_SERIES_STATEMENT, (name, release_year)).lastrowid
+    DIM_CACHE.invalidate('Series')
+    maybe_compact_change_log(con)
+    return rowid
 
 
 def reg_arch(con: sqlite3.Connection, name: str) -> int:
     """Register a new gpu architecture"""
-    return exec_statement(con, INSERT_ARCH_STATEMENT, (name,)).lastrowid
+    rowid = exec_statement(con, INSERT_ARCH_STATEMENT, (name,)).lastrowid
+    DIM_CACHE.invalidate('Architecture')
+    maybe_compact_change_log(con)
+    return rowid
 
 
 def reg_manufacturer(con: sqlite3.Connection, name: str, founded_year: int) -> int:
     """Register a new manufacturer"""
-    return exec_statement(con, INSERT_MANU_STATEMENT, (name, founded_year)).lastrowid
+    rowid = exec_statement(con, INSERT_MANU_STATEMENT, (name, founded_year)).lastrowid
+    DIM_CACHE.invalidate('Manufacturer')
+    maybe_compact_change_log(con)
+    return rowid
 
 
 def reg_proc(con: sqlite3.Connection, name: str, architecture_id: int) -> int:
     """Register a new processor"""
-    return exec_statement(con, INSERT_PROC_STATEMENT, (name, architecture_id)).lastrowid
+    rowid = exec_statement(con, INSERT_PROC_STATEMENT, (name, architecture_id)).lastrowid
+    DIM_CACHE.invalidate('Processor')
+    maybe_compact_change_log(con)
+    return rowid
 
 
 @typing.overload
@@ -45,4 +80,45 @@ def reg_gpu(con: sqlite3.Connection,
 
 
 def reg_gpu(con: sqlite3.Connection, *args) -> int:
-    return exec_statement(con, INSERT_GPU_STATEMENT, tuple(args)).lastrowid
+    shard_nos = attached_shards(con)
+    if shard_nos:
+        gpu_id = insert_gpu(con, shard_nos, args)
+        schema = shard_schema(shard_for_manufacturer(len(shard_nos), args[4]))
+    else:
+        gpu_id = exec_statement(con, INSERT_GPU_STATEMENT, tuple(args)).lastrowid
+        schema = 'main'
+    # start the price history with the launch price, in the file of the GPU
+    exec_statement(con, INSERT_SCHEMA_PRICE_TEMPL.format(schema=schema), (gpu_id, int(time.time()), args[6]))
+    maybe_compact_change_log(con)
+    return gpu_id
+
+
+def reg_price(con: sqlite3.Connection, gpu_id: int, price_us_cents: int) -> int:
+    """Register the current price of a gpu, keeping the previous prices in its history"""
+    append_prices(con, ((gpu_id, int(time.time()), price_us_cents),))
+    return gpu_id
+
+
+def append_prices(con: sqlite3.Connection, samples: typing.Iterable[tuple[int, int, int]]) -> int:
+    """
+    Bulk append price samples to the price history, and update GPU.price_cents to the latest price.
+    A sample for an existing (gpu id, timestamp) replaces it.
+
+    :param samples: (gpu id, unix timestamp, price in US cents) tuples
+    :return: The number of samples appended
+    """
+    shard_nos = attached_shards(con)
+    if shard_nos:
+        count = append_shard_prices(con, shard_nos, samples)
+        maybe_compact_change_log(con)
+        return count
+    gpu_ids = set()
+
+    def track(samples_it):
+        for sample in samples_it:
+            gpu_ids.add(sample[0])
+            yield sample
+    count = con.executemany(INSERT_PRICE_STATEMENT, track(samples)).rowcount
+    con.executemany(UPDATE_GPU_LATEST_PRICE_STATEMENT, ((gpu_id,) for gpu_id in gpu_ids))
+    maybe_compact_change_log(con)
+    return count
@@ -0,0 +1,362 @@
+"""
+Optional sharding of the GPU table across several database files.
+
+A sharded database lists its shard files in the GPUShard table. db_utils.connect() attaches
+them and shadows the GPU, PriceHistory and ChangeLog tables of the main database with temporary
+UNION ALL views of the same names, so the SELECT templates work unchanged and SQLite pushes their
+WHERE clauses down into every shard. GPUs are placed by manufacturer (manufacturer_id modulo the
+shard count), and a shard keeps the prices and the change log of its GPUs, so writing a GPU only
+locks the file of its shard and each file can be vacuumed or backed up alone.
+
+Every change log hands out seqs from its own range, so seqs are unique across the files. Entries
+of different files do not commit in seq order though, so readers keep a position per change log,
+see change_log_position().
+
+Usage: python -m app.shards [--create N] [--vacuum [SHARD ...]]
+"""
+from __future__ import annotations
+import argparse
+import operator
+import os.path
+import sqlite3
+import typing
+
+from . import DB_PATH
+from .db_utils import MAX_IN_LIST, SQL_SelectTempl, connect, exec_statement, exec_statements
+from .sql_statements import (
+    CREATE_SHARD_GPU_TABLE_TEMPL,
+    CREATE_SHARD_LOG_TABLES_TEMPLS,
+    CREATE_SHARDED_TABLE_VIEW_TEMPL,
+    DELETE_CHANGES_AFTER_STATEMENT,
+    DELETE_MAIN_GPUS_STATEMENT,
+    DELETE_MOVED_PRICES_TEMPL,
+    INSERT_GPU_SHARD_STATEMENT,
+    INSERT_SCHEMA_PRICE_TEMPL,
+    INSERT_SHARD_GPU_TEMPL,
+    MAX_SCHEMA_GPU_ID_TEMPL,
+    MOVE_GPUS_TO_SHARD_TEMPL,
+    MOVE_PRICES_TO_SHARD_TEMPL,
+    SELECT_CHANGES_TEMPL,
+    SELECT_GPU_SHARDS,
+    SELECT_GPU_SHARD_TABLE_EXISTS,
+    SELECT_SCHEMA_GPU_IDS_TEMPL,
+    SELECT_SCHEMA_LAST_CHANGE_SEQ_TEMPL,
+    SELECT_SCHEMA_TABLE_EXISTS_TEMPL,
+    SELECT_SCHEMA_TABLE_TEMPL,
+    SHARDED_TABLES,
+    UPDATE_SCHEMA_GPU_LATEST_PRICE_TEMPL,
+)
+from .utils import fmt_table
+
+SHARD_SCHEMA_PREFIX = 'gpu_shard'
+# change log k (0 for the main database, shard_no + 1 for a shard) hands out the seqs
+# after k * CHANGE_LOG_SEQ_SPAN, so that the logs never hand out the same seq
+CHANGE_LOG_SEQ_SPAN = 1 << 48
+
+
+def shard_schema(shard_no: int) -> str:
+    """The name a shard is attached as"""
+    return f'{SHARD_SCHEMA_PREFIX}{shard_no}'
+
+
+def _main_dir(con: sqlite3.Connection) -> str:
+    """The directory of the main database file, shard paths are relative to it"""
+    for _, name, path in exec_statement(con, 'PRAGMA database_list;'):
+        if name == 'main':
+            return os.path.dirname(path)
+    return ''
+
+
+def attached_shards(con: sqlite3.Connection) -> list[int]:
+    """The numbers of the shards attached to a connection, empty if the GPU table is not sharded"""
+    prefix_len = len(SHARD_SCHEMA_PREFIX)
+    return sorted(int(name[prefix_len:]) for _, name, _ in exec_statement(con, 'PRAGMA database_list;')
+                  if name.startswith(SHARD_SCHEMA_PREFIX))
+
+
+def _attach(con: sqlite3.Connection, shard_no: int, path: str):
+    # ATTACH would silently create a missing file, and the GPUs in it would look deleted
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'GPU shard {shard_no} is missing: {path}')
+    exec_statement(con, f'ATTACH DATABASE ? AS "{shard_schema(shard_no)}";', (path,))
+
+
+def _create_temp_objects(con: sqlite3.Connection, shard_nos: list[int]):
+    """Create the views over the tables of the main database and the shards"""
+    schemas = ['main', *map(shard_schema, shard_nos)]
+    exec_statements(con, *(
+        CREATE_SHARDED_TABLE_VIEW_TEMPL.format(table=table, selects='\nUNION ALL\n'.join(
+            SELECT_SCHEMA_TABLE_TEMPL.format(columns=', '.join(columns), schema=schema, table=table)
+            for schema in schemas))
+        for table, columns in SHARDED_TABLES.items()
+    ))
+
+
+def _create_shard_logs(con: sqlite3.Connection, shard_no: int):
+    """Create the price history and change log of a shard, and move the prices of its GPUs there"""
+    schema = shard_schema(shard_no)
+    exec_statements(con, *(templ.format(schema=schema, table='GPU', key='id',
+                                        seq_base=(shard_no + 1) * CHANGE_LOG_SEQ_SPAN)
+                           for templ in CREATE_SHARD_LOG_TABLES_TEMPLS))
+    exec_statement(con, MOVE_PRICES_TO_SHARD_TEMPL.format(schema=schema))
+    exec_statement(con, DELETE_MOVED_PRICES_TEMPL.format(schema=schema))
+
+
+def _has_shard_logs(con: sqlite3.Connection, shard_no: int) -> bool:
+    return exec_statement(con, SELECT_SCHEMA_TABLE_EXISTS_TEMPL.format(schema=shard_schema(shard_no)),
+                          ('ChangeLog',)).fetchone() is not None
+
+
+def attach_shards(con: sqlite3.Connection) -> int:
+    """
+    Attach the GPU shards of a database, if it is sharded, and put the GPU view in place.
+
+    :return: The number of shards
+    """
+    if exec_statement(con, SELECT_GPU_SHARD_TABLE_EXISTS).fetchone() is None:
+        return 0
+    shards = exec_statement(con, SELECT_GPU_SHARDS).fetchall()
+    if not shards:
+        return 0
+    main_dir = _main_dir(con)
+    attached = set(attached_shards(con))
+    for shard_no, path in shards:
+        if shard_no not in attached:
+            _attach(con, shard_no, os.path.join(main_dir, path))
+    shard_nos = [shard_no for shard_no, _ in shards]
+    # shards created before they kept the prices and the change log of their GPUs
+    upgrade = [shard_no for shard_no in shard_nos if not _has_shard_logs(con, shard_no)]
+    if upgrade:
+        for shard_no in upgrade:
+            _create_shard_logs(con, shard_no)
+        con.commit()
+    _create_temp_objects(con, shard_nos)
+    return len(shards)
+
+
+def change_log_schemas(con: sqlite3.Connection) -> list[str]:
+    """The schemas with a change log, in the order of their seq ranges"""
+    return ['main', *map(shard_schema, attached_shards(con))]
+
+
+def change_log_position(con: sqlite3.Connection) -> tuple[int, ...]:
+    """
+    The last seq of every change log, which changes with every write to the database.
+
+    A write to one shard can commit after a greater seq of another shard was read, so
+    readers of the change log keep the seq they read up to per change log.
+    """
+    return tuple(
+        exec_statement(con, SELECT_SCHEMA_LAST_CHANGE_SEQ_TEMPL.format(schema=schema),
+                       (log_no * CHANGE_LOG_SEQ_SPAN,)).fetchone()[0]
+        for log_no, schema in enumerate(change_log_schemas(con)))
+
+
+def position_follows(position: tuple[int, ...], since: tuple[int, ...]) -> bool:
+    """Whether a change log position can follow another one of the same database, False e.g. after switching databases"""
+    return len(position) >= len(since) and all(seq >= since_seq for seq, since_seq in zip(position, since))
+
+
+def select_changes(since: tuple[int, ...], until: tuple[int, ...]) -> list[SQL_SelectTempl]:
+    """
+    SELECT_CHANGES_TEMPL for the changes after since and up to until, one per change log in seq order.
+
+    :param since: A change_log_position, the logs it has no seq for (e.g. shards created after it) are read from their start
+    :param until: The current change_log_position
+    """
+    templs = []
+    for log_no, last in enumerate(until):
+        first = since[log_no] if log_no < len(since) else log_no * CHANGE_LOG_SEQ_SPAN
+        if last > first:
+            templs.append(SELECT_CHANGES_TEMPL.where(r'seq', operator.gt, first).where(r'seq', operator.le, last))
+    return templs
+
+
+def shard_for_manufacturer(shard_count: int, manufacturer_id: int | None) -> int:
+    """The shard the GPUs of a manufacturer are stored in"""
+    return (manufacturer_id or 0) % shard_count
+
+
+def insert_gpu(con: sqlite3.Connection, shard_nos: list[int], args: tuple) -> int:
+    """
+    Insert a GPU into the shard of its manufacturer.
+
+    :param shard_nos: attached_shards(con)
+    :param args: The values of INSERT_GPU_STATEMENT
+    :return: The id of the new GPU
+
+    The new id is the next one above every shard's ids that is equal to shard_no modulo the shard count:
+
+    >>> import tempfile
+    >>> from app.setup import setup_table
+    >>> con = sqlite3.connect(os.path.join(tempfile.mkdtemp(), 'gpus.db'))
+    >>> setup_table(con)
+    >>> _ = create_shards(con, 3)
+    >>> [insert_gpu(con, [0, 1, 2], ('GPU', 1, 1000, 1, manu_id, 8, 10000)) for manu_id in (1, 1, 2, 3)]
+    [4, 7, 11, 12]
+    """
+    shard_no = shard_for_manufacturer(len(shard_nos), args[4])
+    return exec_statement(con, INSERT_SHARD_GPU_TEMPL.format(
+        schema=shard_schema(shard_no),
+        max_ids=', '.join(MAX_SCHEMA_GPU_ID_TEMPL.format(schema=schema)
+                          for schema in ('main', *map(shard_schema, shard_nos))),
+        shard_count=len(shard_nos),
+        shard_no=shard_no,
+    ), tuple(args)).lastrowid
+
+
+def locate_gpus(con: sqlite3.Connection, shard_nos: list[int],
+                gpu_ids: typing.Iterable[int]) -> dict[str, list[int]]:
+    """
+    Find the schema each GPU is stored in, with an index lookup per schema and IN list.
+
+    :return: schema name -> ids of the GPUs stored in it, unknown ids are left out
+    """
+    gpu_ids = list(gpu_ids)
+    located: dict[str, list[int]] = {}
+    for start in range(0, len(gpu_ids), MAX_IN_LIST):
+        chunk = gpu_ids[start:start + MAX_IN_LIST]
+        for schema in ('main', *map(shard_schema, shard_nos)):
+            stmt = SELECT_SCHEMA_GPU_IDS_TEMPL.format(schema=schema, params=', '.join('?' * len(chunk)))
+            located.setdefault(schema, []).extend(row[0] for row in exec_statement(con, stmt, tuple(chunk)))
+    return {schema: ids for schema, ids in located.items() if ids}
+
+
+def append_shard_prices(con: sqlite3.Connection, shard_nos: list[int],
+                        samples: typing.Iterable[tuple[int, int, int]]) -> int:
+    """
+    Sharded version of setup.append_prices, each shard is only written to if it has one of the GPUs.
+
+    :return: The number of samples appended
+    """
+    samples = list(samples)
+    located = locate_gpus(con, shard_nos, {sample[0] for sample in samples})
+    schemas = {gpu_id: schema for schema, ids in located.items() for gpu_id in ids}
+    by_schema: dict[str, list[tuple[int, int, int]]] = {}
+    for sample in samples:
+        # like without shards, the samples of unknown GPUs are kept anyway
+        by_schema.setdefault(schemas.get(sample[0], 'main'), []).append(sample)
+    count = 0
+    for schema, schema_samples in by_schema.items():
+        count += con.executemany(INSERT_SCHEMA_PRICE_TEMPL.format(schema=schema), schema_samples).rowcount
+    for schema, ids in located.items():
+        con.executemany(UPDATE_SCHEMA_GPU_LATEST_PRICE_TEMPL.format(schema=schema), ((gpu_id,) for gpu_id in ids))
+    return count
+
+
+def create_shards(con: sqlite3.Connection, shard_count: int) -> list[str]:
+    """
+    Move the GPUs of an unsharded database, and their prices, into shard_count new files next to it.
+    The change log is left as is, since the GPUs only move.
+
+    :return: The paths of the new shard files
+
+    A shard count above what SQLite can attach fails before any file is created:
+
+    >>> import tempfile
+    >>> from app.setup import setup_table
+    >>> path = os.path.join(tempfile.mkdtemp(), 'gpus.db')
+    >>> con = sqlite3.connect(path)
+    >>> setup_table(con)
+    >>> create_shards(con, con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) + 1)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: SQLite can only attach ... databases, use at most ... shards
+    >>> os.listdir(os.path.dirname(path))
+    ['gpus.db']
+    >>> [os.path.basename(shard_path) for shard_path in create_shards(con, 2)]
+    ['gpus.shard0.db', 'gpus.shard1.db']
+    """
+    if exec_statement(con, SELECT_GPU_SHARD_TABLE_EXISTS).fetchone() is None:
+        raise ValueError('The database needs to be upgraded first')
+    if exec_statement(con, SELECT_GPU_SHARDS).fetchone() is not None:
+        raise ValueError('The GPU table is already sharded')
+    main_dir = _main_dir(con)
+    if not main_dir:
+        raise ValueError('Cannot shard an in-memory database')
+    max_attached = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    attached = sum(1 for _, name, _ in exec_statement(con, 'PRAGMA database_list;') if name not in ('main', 'temp'))
+    if attached + shard_count > max_attached:
+        raise ValueError(f'SQLite can only attach {max_attached} databases, '
+                         f'use at most {max_attached - attached} shards')
+    stem = os.path.splitext(os.path.basename(exec_statement(con, 'PRAGMA database_list;').fetchone()[2]))[0]
+    paths = [f'{stem}.shard{shard_no}.db' for shard_no in range(shard_count)]
+    for path in paths:
+        if os.path.exists(os.path.join(main_dir, path)):
+            raise FileExistsError(f'GPU shard file already exists: {os.path.join(main_dir, path)}')
+
+    # ATTACH does not work inside a transaction, the rest is one transaction over all the files
+    con.commit()
+    created = []
+    try:
+        for shard_no, path in enumerate(paths):
+            open(os.path.join(main_dir, path), 'xb').close()
+            created.append(shard_no)
+            _attach(con, shard_no, os.path.join(main_dir, path))
+        last_seq = exec_statement(con, SELECT_SCHEMA_LAST_CHANGE_SEQ_TEMPL.format(schema='main'), (0,)).fetchone()[0]
+        for shard_no, path in enumerate(paths):
+            schema = shard_schema(shard_no)
+            exec_statement(con, CREATE_SHARD_GPU_TABLE_TEMPL.format(schema=schema))
+            exec_statement(con, MOVE_GPUS_TO_SHARD_TEMPL.format(
+                schema=schema, shard_count=shard_count, shard_no=shard_no))
+            # after the move, so that moving the GPUs is not logged
+            _create_shard_logs(con, shard_no)
+            exec_statement(con, INSERT_GPU_SHARD_STATEMENT, (shard_no, path))
+        exec_statement(con, DELETE_MAIN_GPUS_STATEMENT)
+        exec_statement(con, DELETE_CHANGES_AFTER_STATEMENT, (last_seq,))
+        con.commit()
+    except BaseException:
+        con.rollback()
+        attached_nos = set(attached_shards(con))
+        for shard_no in created:
+            if shard_no in attached_nos:
+                exec_statement(con, f'DETACH DATABASE "{shard_schema(shard_no)}";')
+            os.remove(os.path.join(main_dir, paths[shard_no]))
+        raise
+    _create_temp_objects(con, list(range(shard_count)))
+    return [os.path.join(main_dir, path) for path in paths]
+
+
+def shard_stats(con: sqlite3.Connection) -> list[tuple[str, int, int]]:
+    """(schema, number of GPUs, file size in bytes) of the main database and each shard"""
+    stats = []
+    for _, schema, path in exec_statement(con, 'PRAGMA database_list;'):
+        if schema == 'main' or schema.startswith(SHARD_SCHEMA_PREFIX):
+            count = exec_statement(con, f'SELECT COUNT(*) FROM "{schema}"."GPU";').fetchone()[0]
+            stats.append((schema, count, os.path.getsize(path) if path else 0))
+    return stats
+
+
+def vacuum_shards(con: sqlite3.Connection, shard_nos: typing.Iterable[int]):
+    """Vacuum shard files one at a time, the others stay writable meanwhile"""
+    con.commit()
+    for shard_no in shard_nos:
+        exec_statement(con, f'VACUUM "{shard_schema(shard_no)}";')
+
+
+def main(argv: list[str] | None = None):
+    # setup routes its writes through this module
+    from .setup import upgrade_table
+
+    parser = argparse.ArgumentParser(prog='python -m app.shards',
+                                     description='Shard the GPU table across several database files')
+    parser.add_argument('--create', type=int, default=None, metavar='N',
+                        help='move the GPUs of an unsharded database into N shard files')
+    parser.add_argument('--vacuum', type=int, nargs='*', default=None, metavar='SHARD',
+                        help='vacuum these shards, or all of them')
+    args = parser.parse_args(argv)
+    if args.create is not None and args.create < 1:
+        parser.error('--create needs at least one shard')
+
+    with connect(DB_PATH) as con:
+        if args.create is not None:
+            upgrade_table(con)
+            for path in create_shards(con, args.create):
+                print(f'Created {path}')
+        if args.vacuum is not None:
+            vacuum_shards(con, args.vacuum or attached_shards(con))
+        print(fmt_table([('schema', 'GPUs', 'bytes'), *shard_stats(con)], align_to=str.rjust), end='')
+
+
+if __name__ == '__main__':
+    main()
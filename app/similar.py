@@ -0,0 +1,229 @@
+"""
+In-process nearest-neighbour index of the GPUs, for the "similar GPUs" lists.
+
+Every GPU is a point of standardized features (clock speed, VRAM, price and release year)
+kept in NumPy arrays, so a query is one matrix-vector product over all the rows.
+The index follows the ChangeLog, so a write only costs re-reading the changed rows.
+"""
+from __future__ import annotations
+import copy
+import itertools
+import operator
+import sqlite3
+import threading
+import warnings
+
+import numpy as np
+
+from .db_utils import MAX_IN_LIST, SQL_SelectTempl, fetch_chunks_from_cursor
+from .shards import change_log_position, position_follows, select_changes
+from .sql_statements import SELECT_GPU_FEATURES_TEMPL
+
+FEATURES = ('clock_speed_mhz', 'vram_size_gb', 'price_cents', 'release_year')
+DEFAULT_K = 5
+FETCH_ROWS = 10000
+# rebuild from scratch, which standardizes the features again, once this fraction of the rows was updated
+REBUILD_FRACTION = 0.1
+
+
+def _transform(cols: np.ndarray) -> np.ndarray:
+    """
+    The FEATURES columns to unstandardized features.
+    VRAM and price are log scaled, so that 8 vs 16 GB is as far apart as 16 vs 32 GB.
+    """
+    feats = cols.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        feats[:, 1:3] = np.log1p(feats[:, 1:3])
+    return feats
+
+
+class _Rows:
+    """
+    The points of the index, stored in insertion order with a position per GPU id.
+    Updated GPUs are overwritten, new ones appended and deleted ones masked out.
+    Missing values (NULL columns) are standardized to the average.
+
+    Once published to queries a _Rows is never modified, updates are applied to a copy.
+    """
+
+    ARRAYS = ('ids', 'manu', 'price', 'points', 'norms', 'valid')
+
+    def __init__(self, capacity: int = 0):
+        self.n = 0
+        self.pos: dict[int, int] = {}
+        self.ids = np.zeros(capacity, np.int64)
+        self.manu = np.full(capacity, np.nan)
+        self.price = np.full(capacity, np.nan)
+        self.points = np.zeros((capacity, len(FEATURES)), np.float32)
+        # squared norms of the points, so that distances are a single matrix-vector product
+        self.norms = np.zeros(capacity, np.float32)
+        self.valid = np.zeros(capacity, bool)
+        self.mean = np.zeros(len(FEATURES))
+        self.scale = np.ones(len(FEATURES))
+        # the number of GPUs updated since the build
+        self.updated = 0
+
+    def copy(self) -> _Rows:
+        other = copy.copy(self)
+        other.pos = dict(self.pos)
+        for name in self.ARRAYS:
+            setattr(other, name, getattr(self, name).copy())
+        return other
+
+    def _reserve(self, capacity: int):
+        if capacity <= len(self.ids):
+            return
+        capacity = max(capacity, 2 * len(self.ids))
+        for name in self.ARRAYS:
+            old = getattr(self, name)
+            new = np.zeros((capacity, *old.shape[1:]), old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    @staticmethod
+    def _fetch(con: sqlite3.Connection, templ: SQL_SelectTempl) -> np.ndarray:
+        """The rows of SELECT_GPU_FEATURES_TEMPL as floats, NULL becomes NaN"""
+        chunks = [np.array(chunk, np.float64)
+                  for chunk in fetch_chunks_from_cursor(templ.execute_on_dbcon(con), FETCH_ROWS)]
+        return np.concatenate(chunks) if chunks else np.empty((0, 2 + len(FEATURES)))
+
+    def _upsert(self, rows: np.ndarray):
+        ids = rows[:, 0].astype(np.int64)
+        positions = np.fromiter((self.pos.get(id_, -1) for id_ in ids.tolist()), np.int64, len(ids))
+        new = positions < 0
+        n_new = int(np.count_nonzero(new))
+        self._reserve(self.n + n_new)
+        positions[new] = np.arange(self.n, self.n + n_new)
+        self.pos.update(zip(ids[new].tolist(), positions[new].tolist()))
+        self.n += n_new
+
+        points = np.nan_to_num((_transform(rows[:, 2:]) - self.mean) / self.scale, nan=0.0).astype(np.float32)
+        self.ids[positions] = ids
+        self.manu[positions] = rows[:, 1]
+        self.price[positions] = rows[:, 4]
+        self.points[positions] = points
+        self.norms[positions] = np.einsum('ij,ij->i', points, points)
+        self.valid[positions] = True
+
+    @classmethod
+    def build(cls, con: sqlite3.Connection) -> _Rows:
+        rows = cls._fetch(con, SELECT_GPU_FEATURES_TEMPL)
+        self = cls(len(rows))
+        feats = _transform(rows[:, 2:])
+        # all NULL columns (or no rows at all) would warn about empty slices
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean, std = np.nanmean(feats, axis=0), np.nanstd(feats, axis=0)
+        self.mean = np.nan_to_num(mean, nan=0.0)
+        self.scale = np.where(np.isnan(std) | (std == 0), 1.0, std)
+        self._upsert(rows)
+        return self
+
+    def update(self, con: sqlite3.Connection, gpu_ids: list[int]):
+        found = set()
+        for start in range(0, len(gpu_ids), MAX_IN_LIST):
+            rows = self._fetch(con, SELECT_GPU_FEATURES_TEMPL.where(
+                r'GPU.id', operator.contains, gpu_ids[start:start + MAX_IN_LIST]))
+            self._upsert(rows)
+            found.update(rows[:, 0].astype(np.int64).tolist())
+        for gpu_id in gpu_ids:
+            if gpu_id not in found and gpu_id in self.pos:
+                self.valid[self.pos.pop(gpu_id)] = False
+        self.updated += len(gpu_ids)
+
+
+class SimilarityIndex:
+    """
+    A thread-safe k-nearest-neighbour index over all the GPUs.
+
+    Refreshes build new rows next to the ones queries are reading, and swap them in when done.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # held while refreshing, so that concurrent requests load the changes once
+        self._load_lock = threading.Lock()
+        # the change_log_position the rows are up to date with
+        self._seq: tuple[int, ...] | None = None
+        self._rows = _Rows()
+
+    def refresh(self, con: sqlite3.Connection):
+        """Catch up with the changes made to the GPU and Series tables since the last refresh"""
+        last_seq = change_log_position(con)
+        with self._lock:
+            if last_seq == self._seq:
+                return
+        with self._load_lock:
+            # another thread may have caught up while this one waited
+            last_seq = change_log_position(con)
+            with self._lock:
+                seq, rows = self._seq, self._rows
+            if last_seq == seq:
+                return
+            rebuild = seq is None or not position_follows(last_seq, seq)
+            gpu_ids: dict[int, None] = {}
+            if not rebuild:
+                changes = itertools.chain.from_iterable(
+                    templ.where(r'table_name', operator.contains, ('GPU', 'Series')).execute_on_dbcon(con, lazy=True).tuples()
+                    for templ in select_changes(seq, last_seq))
+                for _, table, row_id, op in changes:
+                    if table == 'GPU':
+                        gpu_ids[row_id] = None
+                    elif op != 'insert':
+                        # a release year changed for a whole series, new series have no GPUs yet
+                        rebuild = True
+                        break
+                rebuild = rebuild or rows.updated + len(gpu_ids) > REBUILD_FRACTION * rows.n
+            if rebuild:
+                rows = _Rows.build(con)
+            elif gpu_ids:
+                rows = rows.copy()
+                rows.update(con, list(gpu_ids))
+            with self._lock:
+                self._seq, self._rows = last_seq, rows
+
+    def similar(self, con: sqlite3.Connection, gpu_id: int, k: int = DEFAULT_K,
+                same_manufacturer: bool = False, max_price_cents: int | None = None) -> list[tuple[int, float]] | None:
+        """
+        Find the GPUs closest to a GPU in the standardized feature space.
+
+        :param k: The maximum number of GPUs to return
+        :param same_manufacturer: Only return GPUs of the manufacturer of gpu_id
+        :param max_price_cents: Only return GPUs with a known price up to this
+        :return: (id, distance) pairs, closest first, or None if gpu_id does not exist
+        """
+        self.refresh(con)
+        with self._lock:
+            rows = self._rows
+        pos = rows.pos.get(gpu_id)
+        if pos is None:
+            return None
+        n = rows.n
+        ids, manu, price = rows.ids[:n], rows.manu[:n], rows.price[:n]
+        points, norms, valid = rows.points[:n], rows.norms[:n], rows.valid[:n]
+        query, query_manu = points[pos], manu[pos]
+
+        # |p - q|^2 = |p|^2 - 2 p.q + |q|^2, where |q|^2 does not change the order
+        dist = norms - 2 * (points @ query)
+        mask = valid.copy()
+        mask[pos] = False
+        if same_manufacturer:
+            mask &= manu == query_manu
+        if max_price_cents is not None:
+            mask &= price <= max_price_cents
+        dist[~mask] = np.inf
+        k = min(k, int(np.count_nonzero(mask)))
+        if k <= 0:
+            return []
+        nearest = np.argpartition(dist, k - 1)[:k]
+        nearest = nearest[np.argsort(dist[nearest], kind='stable')]
+        query_norm = float(query @ query)
+        return [(int(ids[i]), float(np.sqrt(max(dist[i] + query_norm, 0.0)))) for i in nearest]
+
+    def invalidate(self):
+        """Rebuild the index on next use, e.g. after switching databases"""
+        with self._lock:
+            self._seq = None
+
+
+SIMILAR_INDEX = SimilarityIndex()
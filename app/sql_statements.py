@@ -2,6 +2,78 @@
 from .db_utils import SQL_SelectTempl
 
 
+# clustered by (gpu_id, recorded_at), so a range of one GPU's prices is contiguous
+PRICE_HISTORY_TABLE_TEMPL = r'''
+    CREATE TABLE IF NOT EXISTS "{schema}"."PriceHistory" (
+    "gpu_id" INTEGER,
+    "recorded_at" INTEGER,
+    "price_cents" INTEGER,
+    PRIMARY KEY ("gpu_id", "recorded_at"),
+    CONSTRAINT "FK_PriceHistory.gpu_id"
+        FOREIGN KEY ("gpu_id")
+        REFERENCES "GPU"("id")
+    ) WITHOUT ROWID;
+    '''
+PRICE_HISTORY_TABLE_STATEMENTS = [PRICE_HISTORY_TABLE_TEMPL.format(schema='main')]
+
+# table name -> primary key column, changes to these tables are appended to the ChangeLog
+CHANGE_TRACKED_TABLES = {
+    'Architecture': 'arch_id',
+    'Processor': 'proc_id',
+    'Manufacturer': 'manufacturer_id',
+    'Series': 'series_id',
+    'GPU': 'id',
+}
+
+# AUTOINCREMENT so that sequence numbers are never reused, even after compaction
+CHANGE_LOG_TABLE_TEMPL = r'''
+    CREATE TABLE IF NOT EXISTS "{schema}"."ChangeLog" (
+    "seq" INTEGER PRIMARY KEY AUTOINCREMENT,
+    "table_name" TEXT NOT NULL,
+    "row_id" INTEGER NOT NULL,
+    "op" TEXT NOT NULL
+    );
+    '''
+# the table of a trigger is in the schema of the trigger, and so is the ChangeLog it inserts into
+CHANGE_LOG_TRIGGER_TEMPLS = [
+    rf'''
+    CREATE TRIGGER IF NOT EXISTS "{{schema}}"."ChangeLog_{{table}}_{op}" AFTER {op.upper()} ON "{{table}}"
+    BEGIN
+    INSERT INTO ChangeLog (table_name, row_id, op) VALUES ('{{table}}', {row}."{{key}}", '{op}');
+    END;
+    '''
+    for op, row in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD'))
+]
+CHANGE_LOG_TABLE_STATEMENTS = [
+    CHANGE_LOG_TABLE_TEMPL.format(schema='main'),
+    *(
+        templ.format(schema='main', table=table, key=key)
+        for table, key in CHANGE_TRACKED_TABLES.items()
+        for templ in CHANGE_LOG_TRIGGER_TEMPLS
+    ),
+]
+# Log the rows of a database that existed before the ChangeLog did, so that syncing from 0 gets everything
+BACKFILL_CHANGE_LOG_STATEMENTS = [
+    rf'''INSERT INTO ChangeLog (table_name, row_id, op) SELECT '{table}', "{key}", 'insert' FROM "{table}";'''
+    for table, key in CHANGE_TRACKED_TABLES.items()
+]
+# Start the price history of the GPUs of a database that existed before it did with their current price
+BACKFILL_PRICE_HISTORY_STATEMENT = r'''
+INSERT INTO PriceHistory (gpu_id, recorded_at, price_cents)
+SELECT id, ?, price_cents FROM GPU WHERE price_cents IS NOT NULL;
+'''
+
+# the files the GPU table is sharded across, empty if it is not, see app/shards.py
+GPU_SHARD_TABLE_STATEMENTS = [
+    r'''
+    CREATE TABLE IF NOT EXISTS "GPUShard" (
+    "shard_no" INTEGER,
+    "path" TEXT NOT NULL,
+    PRIMARY KEY ("shard_no")
+    );
+    ''',
+]
+
 CREATE_TABLE_STATEMENTS = [
     r'''
     CREATE TABLE "Architecture" (
@@ -54,7 +126,16 @@ CREATE_TABLE_STATEMENTS = [
         FOREIGN KEY ("series_id")
         REFERENCES "Series"("series_id")
     );
-    '''
+    ''',
+    *PRICE_HISTORY_TABLE_STATEMENTS,
+    *CHANGE_LOG_TABLE_STATEMENTS,
+    *GPU_SHARD_TABLE_STATEMENTS,
+]
+# Run on databases created before these tables existed
+UPGRADE_TABLE_STATEMENTS = [
+    *PRICE_HISTORY_TABLE_STATEMENTS,
+    *CHANGE_LOG_TABLE_STATEMENTS,
+    *GPU_SHARD_TABLE_STATEMENTS,
 ]
 INSERT_SERIES_STATEMENT = r'''INSERT INTO Series (series_name, release_year) VALUES (?, ?);'''
 INSERT_ARCH_STATEMENT = r'''INSERT INTO Architecture (arch_name) VALUES (?);'''
@@ -66,6 +147,18 @@ INSERT INTO GPU
 VALUES
 (?, ?, ?, ?, ?, ?, ?);
 '''
+INSERT_SCHEMA_PRICE_TEMPL = r'''INSERT OR REPLACE INTO "{schema}"."PriceHistory" (gpu_id, recorded_at, price_cents) VALUES (?, ?, ?);'''
+INSERT_PRICE_STATEMENT = INSERT_SCHEMA_PRICE_TEMPL.format(schema='main')
+UPDATE_SCHEMA_GPU_LATEST_PRICE_TEMPL = r'''
+UPDATE "{schema}"."GPU" SET price_cents = (
+    SELECT price_cents FROM "{schema}"."PriceHistory"
+    WHERE PriceHistory.gpu_id = GPU.id
+    ORDER BY recorded_at DESC
+    LIMIT 1
+)
+WHERE id = ? AND EXISTS (SELECT 1 FROM "{schema}"."PriceHistory" WHERE PriceHistory.gpu_id = GPU.id);
+'''
+UPDATE_GPU_LATEST_PRICE_STATEMENT = UPDATE_SCHEMA_GPU_LATEST_PRICE_TEMPL.format(schema='main')
 
 SELECT_GET_GPU_DETAILS_TEMPL = SQL_SelectTempl(rf'''
 SELECT
@@ -136,3 +229,211 @@ FROM Architecture
 {{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
 ;
 ''')
+
+SELECT_GPU_ROWS_TEMPL = SQL_SelectTempl(rf'''
+SELECT
+GPU.id,
+GPU.name,
+GPU.proc_id,
+GPU.clock_speed_mhz,
+GPU.series_id,
+GPU.manufacturer_id,
+GPU.vram_size_gb,
+GPU.price_cents
+FROM GPU
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+# the numeric columns of the GPUs, for the similarity index
+SELECT_GPU_FEATURES_TEMPL = SQL_SelectTempl(rf'''
+SELECT
+GPU.id,
+GPU.manufacturer_id,
+GPU.clock_speed_mhz,
+GPU.vram_size_gb,
+GPU.price_cents,
+Series.release_year
+FROM GPU
+JOIN Series ON GPU.series_id = Series.series_id
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+# facet buckets, a value v is in bucket i if edges[i - 1] <= v < edges[i]
+VRAM_BUCKET_EDGES_GB = (4, 8, 12, 16, 24)
+PRICE_BAND_EDGES_CENTS = (20000, 40000, 60000, 100000, 150000)
+# the CAST gives the expression an INTEGER affinity, so that `IN (?, ...)` matches the string params of where()
+VRAM_BUCKET_SQL, PRICE_BAND_SQL = (
+    f'CAST(CASE WHEN {col} IS NULL THEN NULL '
+    + ' '.join(f'WHEN {col} < {edge} THEN {idx}' for idx, edge in enumerate(edges))
+    + f' ELSE {len(edges)} END AS INTEGER)'
+    for col, edges in ((r'GPU.vram_size_gb', VRAM_BUCKET_EDGES_GB), (r'GPU.price_cents', PRICE_BAND_EDGES_CENTS))
+)
+# the architecture of a GPU through its processor, as in the join of SELECT_FACET_COUNTS_TEMPL
+ARCH_OF_GPU_SQL = r'CAST((SELECT Processor.arch_id FROM Processor WHERE Processor.proc_id = GPU.proc_id) AS INTEGER)'
+# the number of GPUs per combination of facet values, grouped by SELECT_FACET_COUNTS_GROUP_BY
+SELECT_FACET_COUNTS_TEMPL = SQL_SelectTempl(rf'''
+SELECT
+GPU.manufacturer_id,
+Processor.arch_id,
+GPU.series_id,
+{VRAM_BUCKET_SQL} AS vram_bucket,
+{PRICE_BAND_SQL} AS price_band,
+COUNT(*) AS gpus
+FROM GPU
+LEFT JOIN Processor ON GPU.proc_id = Processor.proc_id
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+SELECT_FACET_COUNTS_GROUP_BY = (r'GPU.manufacturer_id', r'Processor.arch_id', r'GPU.series_id', r'vram_bucket', r'price_band')
+
+SELECT_ARCH_ROWS = SQL_SelectTempl(rf'''
+SELECT arch_id, arch_name
+FROM Architecture
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+SELECT_PROC_ROWS = SQL_SelectTempl(rf'''
+SELECT proc_id, proc_name, arch_id
+FROM Processor
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+SELECT_SERIES_ROWS = SQL_SelectTempl(rf'''
+SELECT series_id, series_name, release_year
+FROM Series
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+SELECT_MANU_ROWS = SQL_SelectTempl(rf'''
+SELECT manufacturer_id, manufacturer_name, founded_year
+FROM Manufacturer
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+SELECT_PRICE_HISTORY_TEMPL = SQL_SelectTempl(rf'''
+SELECT recorded_at, price_cents
+FROM PriceHistory
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+
+# resolution -> (average) length of a bucket, months and years are calendar months and years
+PRICE_BUCKET_SECONDS = {
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 2629746,
+    'year': 31556952,
+}
+# the unix epoch is a thursday, shift the buckets so that weeks start on monday
+PRICE_BUCKET_OFFSET_SECONDS = 3 * 24 * 60 * 60
+# resolution -> the start of the bucket of a sample, as a unix timestamp
+PRICE_BUCKET_START_SQL = {
+    **{
+        resolution: f'(recorded_at + {PRICE_BUCKET_OFFSET_SECONDS}) / {seconds} * {seconds} - {PRICE_BUCKET_OFFSET_SECONDS}'
+        for resolution, seconds in PRICE_BUCKET_SECONDS.items() if resolution in ('day', 'week')
+    },
+    'month': r"CAST(strftime('%s', recorded_at, 'unixepoch', 'start of month') AS INTEGER)",
+    'year': r"CAST(strftime('%s', recorded_at, 'unixepoch', 'start of year') AS INTEGER)",
+}
+
+SELECT_PRICE_BUCKETS_TEMPLS = {
+    resolution: SQL_SelectTempl(rf'''
+SELECT
+{bucket_start} AS bucket_start,
+MIN(price_cents) AS min_price_cents,
+AVG(price_cents) AS avg_price_cents,
+MAX(price_cents) AS max_price_cents,
+COUNT(*) AS samples
+FROM PriceHistory
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+    for resolution, bucket_start in PRICE_BUCKET_START_SQL.items()
+}
+
+SELECT_CHANGES_TEMPL = SQL_SelectTempl(rf'''
+SELECT seq, table_name, row_id, op
+FROM ChangeLog
+{{{SQL_SelectTempl.SQL_MORE_PLACEHOLDER}}}
+;
+''')
+# the parameter is the seq of an empty change log
+SELECT_SCHEMA_LAST_CHANGE_SEQ_TEMPL = r'''SELECT COALESCE(MAX(seq), ?) FROM "{schema}"."ChangeLog";'''
+SELECT_CHANGE_LOG_EXISTS = r'''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ChangeLog';'''
+SELECT_PRICE_HISTORY_EXISTS = r'''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'PriceHistory';'''
+# keep only the latest entry of each row, a consumer syncing from any seq still sees every row changed after it
+COMPACT_SCHEMA_CHANGE_LOG_TEMPL = r'''
+DELETE FROM "{schema}"."ChangeLog"
+WHERE seq NOT IN (SELECT MAX(seq) FROM "{schema}"."ChangeLog" GROUP BY table_name, row_id);
+'''
+
+SELECT_GPU_SHARDS = r'''SELECT shard_no, path FROM GPUShard ORDER BY shard_no;'''
+SELECT_GPU_SHARD_TABLE_EXISTS = r'''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'GPUShard';'''
+INSERT_GPU_SHARD_STATEMENT = r'''INSERT INTO GPUShard (shard_no, path) VALUES (?, ?);'''
+GPU_COLUMNS = ('id', 'name', 'proc_id', 'clock_speed_mhz', 'series_id', 'manufacturer_id', 'vram_size_gb', 'price_cents')
+# the GPU table of a shard, without the foreign keys since they cannot reference the main database
+CREATE_SHARD_GPU_TABLE_TEMPL = r'''
+CREATE TABLE "{schema}"."GPU" (
+"id" INTEGER,
+"name" TEXT,
+"proc_id" INTEGER,
+"clock_speed_mhz" INTEGER,
+"series_id" INTEGER,
+"manufacturer_id" INTEGER,
+"vram_size_gb" INTEGER,
+"price_cents" INTEGER,
+PRIMARY KEY ("id")
+);
+'''
+# the tables kept in every shard, merged with the table of the main database on read. table -> columns
+SHARDED_TABLES = {
+    'GPU': GPU_COLUMNS,
+    'PriceHistory': ('gpu_id', 'recorded_at', 'price_cents'),
+    'ChangeLog': ('seq', 'table_name', 'row_id', 'op'),
+}
+# shadows main.{table} for this connection, {selects} is SELECT_SCHEMA_TABLE_TEMPL for each schema
+CREATE_SHARDED_TABLE_VIEW_TEMPL = r'''
+CREATE TEMP VIEW IF NOT EXISTS "{table}" AS
+{selects};
+'''
+SELECT_SCHEMA_TABLE_TEMPL = r'''SELECT {columns} FROM "{schema}"."{table}"'''
+SELECT_SCHEMA_TABLE_EXISTS_TEMPL = r'''SELECT 1 FROM "{schema}"."sqlite_master" WHERE type = 'table' AND name = ?;'''
+# The price history and change log of the GPUs of a shard, so that writing a GPU only locks its shard.
+# The seqs of the change log start after {seq_base}, see app/shards.py
+CREATE_SHARD_LOG_TABLES_TEMPLS = [
+    PRICE_HISTORY_TABLE_TEMPL,
+    CHANGE_LOG_TABLE_TEMPL,
+    r'''INSERT INTO "{schema}"."sqlite_sequence" (name, seq) VALUES ('ChangeLog', {seq_base});''',
+    *CHANGE_LOG_TRIGGER_TEMPLS,
+]
+# {max_ids} is MAX_SCHEMA_GPU_ID_TEMPL for each schema. The new id is above every id of every shard
+# and equal to shard_no modulo the shard count, so shards never hand out the same id without
+# having to lock each other.
+INSERT_SHARD_GPU_TEMPL = r'''
+INSERT INTO "{schema}"."GPU"
+(id, name, proc_id, clock_speed_mhz, series_id, manufacturer_id, vram_size_gb, price_cents)
+SELECT (MAX({max_ids}) / {shard_count} + 1) * {shard_count} + {shard_no}, ?, ?, ?, ?, ?, ?, ?;
+'''
+MAX_SCHEMA_GPU_ID_TEMPL = r'''COALESCE((SELECT MAX(id) FROM "{schema}"."GPU"), 0)'''
+SELECT_SCHEMA_GPU_IDS_TEMPL = r'''SELECT id FROM "{schema}"."GPU" WHERE id IN ({params});'''
+# the rows of the main GPU table once copied to the shards
+MOVE_GPUS_TO_SHARD_TEMPL = rf'''
+INSERT INTO "{{schema}}"."GPU" ({", ".join(GPU_COLUMNS)})
+SELECT {", ".join(GPU_COLUMNS)} FROM "main"."GPU"
+WHERE COALESCE(manufacturer_id, 0) % {{shard_count}} = {{shard_no}};
+'''
+DELETE_MAIN_GPUS_STATEMENT = r'''DELETE FROM "main"."GPU";'''
+# the prices of the GPUs of a shard, once the GPUs were moved to it
+MOVE_PRICES_TO_SHARD_TEMPL = r'''
+INSERT OR REPLACE INTO "{schema}"."PriceHistory" (gpu_id, recorded_at, price_cents)
+SELECT gpu_id, recorded_at, price_cents FROM "main"."PriceHistory"
+WHERE gpu_id IN (SELECT id FROM "{schema}"."GPU");
+'''
+DELETE_MOVED_PRICES_TEMPL = r'''DELETE FROM "main"."PriceHistory" WHERE gpu_id IN (SELECT id FROM "{schema}"."GPU");'''
+DELETE_CHANGES_AFTER_STATEMENT = r'''DELETE FROM "main"."ChangeLog" WHERE seq > ?;'''
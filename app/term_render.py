@@ -0,0 +1,166 @@
+"""Diff-based terminal rendering for the console screens."""
+from __future__ import annotations
+import shutil
+import sys
+import typing
+
+CSI = '\033['
+
+
+def term_size() -> tuple[int, int]:
+    """Get the terminal size as (columns, lines)"""
+    size = shutil.get_terminal_size()
+    return size.columns, size.lines
+
+
+class DiffRenderer:
+    """
+    Keeps the previously drawn frame and only rewrites the rows that changed.
+
+    Every line passed to render() must fit on a single terminal row, otherwise
+    the row addressing goes out of sync with what is on the screen.
+    """
+
+    def __init__(self, stream: typing.TextIO | None = None):
+        self._stream = stream
+        self._frame: list[str] | None = None
+
+    @property
+    def stream(self) -> typing.TextIO:
+        return sys.stdout if self._stream is None else self._stream
+
+    def _write(self, data: str):
+        if data:
+            self.stream.write(data)
+            self.stream.flush()
+
+    def invalidate(self):
+        """Forget the drawn frame, the next render clears the screen and draws everything."""
+        self._frame = None
+
+    def scroll(self, top: int, bottom: int, n: int):
+        """
+        Scroll the rows [top, bottom) of the drawn frame using a terminal scroll region.
+        Rows that scroll in are blank, the next render only has to fill those.
+
+        :param top: The first row of the region (0-based)
+        :param bottom: The row after the last row of the region
+        :param n: The number of rows to scroll, positive to move the content up, negative to move it down
+        """
+        if self._frame is None or n == 0:
+            return
+        if abs(n) >= bottom - top:
+            # nothing would survive the scroll, let render() redraw the rows
+            return
+        frame = self._frame
+        if len(frame) < bottom:
+            frame.extend('' for _ in range(bottom - len(frame)))
+        region = frame[top:bottom]
+        if n > 0:
+            region = region[n:] + [''] * n
+            seq = f'{CSI}{n}S'
+        else:
+            region = [''] * -n + region[:n]
+            seq = f'{CSI}{-n}T'
+        frame[top:bottom] = region
+        self._write(f'{CSI}{top + 1};{bottom}r{seq}{CSI}r')
+
+    def render(self, lines: typing.Sequence[str]) -> int:
+        """
+        Draw a frame, writing only the rows that differ from the previous one.
+
+        :param lines: The rows of the frame, without trailing newlines
+        :return: The number of rows written
+        """
+        out = []
+        prev = self._frame
+        if prev is None:
+            out.append(f'{CSI}H{CSI}J')
+            prev = []
+        written = 0
+        for row, line in enumerate(lines):
+            if row < len(prev) and prev[row] == line:
+                continue
+            out.append(f'{CSI}{row + 1};1H{CSI}2K{line}')
+            written += 1
+        if len(prev) > len(lines):
+            # erase the rows left over from a longer frame
+            out.append(f'{CSI}{len(lines) + 1};1H{CSI}J')
+        # park the cursor below the frame, like a plain print would
+        out.append(f'{CSI}{len(lines) + 1};1H')
+        self._write(''.join(out))
+        self._frame = list(lines)
+        return written
+
+
+class Viewport:
+    """A scrollable window over a list of lines."""
+
+    def __init__(self, lines: typing.Sequence[str], height: int, width: int | None = None):
+        """
+        :param lines: All the lines that can be scrolled through
+        :param height: The number of visible rows
+        :param width: The number of visible columns, None to not clip the lines
+        """
+        self.lines = lines
+        self.height = max(height, 1)
+        self.width = width
+        self.top = 0
+        self.left = 0
+
+    @property
+    def max_top(self) -> int:
+        return max(len(self.lines) - self.height, 0)
+
+    @property
+    def max_left(self) -> int:
+        if self.width is None or not self.lines:
+            return 0
+        return max(max(len(line) for line in self.lines) - self.width, 0)
+
+    def resize(self, height: int, width: int | None = None):
+        self.height = max(height, 1)
+        self.width = width
+        self.scroll_to(self.top)
+        self.hscroll_to(self.left)
+
+    def scroll_to(self, top: int) -> int:
+        """
+        Scroll vertically so that top is the first visible line.
+
+        :return: The number of rows actually scrolled, to be passed to DiffRenderer.scroll
+        """
+        old = self.top
+        self.top = min(max(top, 0), self.max_top)
+        return self.top - old
+
+    def scroll_by(self, n: int) -> int:
+        return self.scroll_to(self.top + n)
+
+    def hscroll_to(self, left: int) -> int:
+        old = self.left
+        self.left = min(max(left, 0), self.max_left)
+        return self.left - old
+
+    def hscroll_by(self, n: int) -> int:
+        return self.hscroll_to(self.left + n)
+
+    def ensure_visible(self, idx: int) -> int:
+        """Scroll the least amount needed for line idx to be visible"""
+        if idx < self.top:
+            return self.scroll_to(idx)
+        elif idx >= self.top + self.height:
+            return self.scroll_to(idx - self.height + 1)
+        return 0
+
+    def visible_range(self) -> range:
+        return range(self.top, min(self.top + self.height, len(self.lines)))
+
+    def clip(self, line: str) -> str:
+        """Clip a line to the visible columns"""
+        if self.width is None:
+            return line
+        return line[self.left:self.left + self.width]
+
+    def visible(self) -> list[str]:
+        return [self.clip(self.lines[idx]) for idx in self.visible_range()]
@@ -7,13 +7,13 @@ import time
 import traceback
 import inspect
 from dataclasses import dataclass
+from .term_render import DiffRenderer, Viewport, term_size
 
 
 def current_year() -> int:
     return datetime.datetime.now().year
 
 
-# TODO: page
 def fmt_table(table: list[tuple], intersection: str = '+', hbar: str = '-',
               vbar: str = '|', lmargin: int = 1, rmargin: int = 1,
               align_to=str.center, fill_char=' ') -> str:
@@ -69,7 +69,49 @@ class FancyMenuKeyBinds:
     UP_KEYS: tuple[str]
 
 
-# TODO: page
+def default_kbinds() -> FancyMenuKeyBinds:
+    import os
+    return FancyMenuKeyBinds(
+        SELECT_KEYS=('\n', '\r'),
+        EXIT_KEYS=('q', '\x1b'),
+        DOWN_KEYS=('j', *(('\xe0P', '\x00P') if os.name == 'nt' else ('\x1b[B',))),
+        UP_KEYS=('k', *(('\xe0H', '\x00H') if os.name == 'nt' else ('\x1b[A',)))
+    )
+
+
+def get_key() -> str:
+    """Read a single key press, escape sequences are returned as a whole"""
+    import os
+    if os.name == 'nt':
+        import msvcrt
+        ch = msvcrt.getch()
+        if ch in (b'\xe0', b'\x00'):
+            ch += msvcrt.getch()
+        elif ch == b'\x03':
+            raise KeyboardInterrupt
+        elif ch == b'\x1a':
+            raise EOFError
+        return ch.decode('utf-8', errors='ignore')
+    else:
+        import sys
+        import tty
+        import termios
+        fd = sys.stdin.fileno()
+        old_settings = termios.tcgetattr(fd)
+        try:
+            tty.setraw(fd)
+            ch = sys.stdin.read(1)
+            if not ch:
+                raise EOFError
+            elif ch == '\x03':
+                raise KeyboardInterrupt
+            if ch == '\x1b':  # Escape sequence
+                ch += sys.stdin.read(2)  # Read next two chars (arrow keys)
+            return ch
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+
+
 def fancy_console_menu(title: str,
                        options: list[tuple[str, typing.Optional[typing.Callable[[int, str, typing.Any, dict], tuple[bool, typing.Any]]]]],
                        bottom_note: str | None = None,
@@ -114,24 +156,37 @@ def fancy_console_menu(title: str,
     :raises EOFError: If Ctrl+Z (Windows) or Ctrl+D (Unix) is pressed.
     """
     arg_dict = dict(locals())
-    import os
     if kbinds is None:
-        kbinds = FancyMenuKeyBinds(
-            SELECT_KEYS=('\n', '\r'),
-            EXIT_KEYS=('q', '\x1b'),
-            DOWN_KEYS=('j', *(('\xe0P', '\x00P') if os.name == 'nt' else ('\x1b[B'))),
-            UP_KEYS=('k', *(('\xe0H', '\x00H') if os.name == 'nt' else ('\x1b[A')))
-        )
+        kbinds = default_kbinds()
+
+    head = str(title).split('\n')
+    # the title is printed without a trailing newline, so its last line
+    # shares a row with the first visible option
+    head_tail = head.pop()
+    foot = (str(bottom_note) if bottom_note is not None else
+            '\nUse j, k, arrow keys or number keys to navigate, enter to select, and q or esc to quit\n').split('\n')
+    if foot[-1] == '':
+        foot.pop()
+    items = [f'{idx + 1}. {str(opt[0])}' for idx, opt in enumerate(options)]
+    renderer = DiffRenderer()
+    viewport = Viewport(items, 1)
+
+    def layout() -> bool:
+        """Fit the viewport to the terminal, returns whether the size changed"""
+        columns, lines = term_size()
+        size = viewport.height, viewport.width
+        # keep a spare row for the cursor below the frame
+        viewport.resize(lines - len(head) - len(foot) - 1, columns)
+        return size != (viewport.height, viewport.width)
 
     def pmenu(hl_idx: int = initial_idx):
-        print(str(title), end='')
-        for idx, opt in enumerate(options):
-            item = f'{idx + 1}. {str(opt[0])}'
-            print(f'{hl_prefix}{item}{hl_suffix}' if idx == hl_idx else item)
-        if bottom_note is not None:
-            print(str(bottom_note), end='')
-        else:
-            print('\nUse j, k, arrow keys or number keys to navigate, enter to select, and q or esc to quit')
+        frame = [line[:viewport.width] for line in head]
+        for row, idx in enumerate(viewport.visible_range()):
+            item = viewport.clip((head_tail if row == 0 else '') + items[idx])
+            frame.append(f'{hl_prefix}{item}{hl_suffix}' if idx == hl_idx else item)
+        if not items:
+            frame.append(head_tail)
+        renderer.render(frame + [line[:viewport.width] for line in foot])
 
     def return_hook(idx: int | None = default_idx) -> tuple[int, str, typing.Any] | None:
         if idx is None:
@@ -143,46 +198,21 @@ def fancy_console_menu(title: str,
             return (idx, opt_name, retn)
         return (idx, opt_name, None)
 
-    def get_key():
-        if os.name == 'nt':
-            import msvcrt
-            ch = msvcrt.getch()
-            if ch in (b'\xe0', b'\x00'):
-                ch += msvcrt.getch()
-            elif ch == b'\x03':
-                raise KeyboardInterrupt
-            elif ch == b'\x1a':
-                raise EOFError
-            return ch.decode('utf-8', errors='ignore')
-        else:
-            import sys
-            import tty
-            import termios
-            fd = sys.stdin.fileno()
-            old_settings = termios.tcgetattr(fd)
-            try:
-                tty.setraw(fd)
-                ch = sys.stdin.read(1)
-                if not ch:
-                    raise EOFError
-                elif ch == '\x03':
-                    raise KeyboardInterrupt
-                if ch == '\x1b':  # Escape sequence
-                    ch += sys.stdin.read(2)  # Read next two chars (arrow keys)
-                return ch
-            finally:
-                termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-
+    layout()
     if not options:
         pmenu()
         return return_hook(None)
 
-    curr_idx = initial_idx
+    curr_idx = initial_idx % len(options)
+    viewport.ensure_visible(curr_idx)
     refresh = True
     try:
         while True:
             if refresh:
-                reset_cursor()
+                if layout():
+                    renderer.invalidate()
+                # only the rows scrolled into view and the (un)highlighted ones get redrawn
+                renderer.scroll(len(head), len(head) + viewport.height, viewport.ensure_visible(curr_idx))
                 pmenu(curr_idx)
                 refresh = False
             key = get_key()
@@ -206,6 +236,58 @@ def fancy_console_menu(title: str,
         return return_hook(default_idx)
 
 
+def console_pager(text: str, bottom_note: str | None = None,
+                  kbinds: FancyMenuKeyBinds | None = None) -> None:
+    """
+    Displays text in a scrollable viewport, only redrawing the rows that changed.
+
+    :param text: The text to display, e.g. the output of fmt_table
+    :param bottom_note: A message displayed below the viewport, defaults to the key help
+    :param kbinds: Key bindings for scrolling, both SELECT_KEYS and EXIT_KEYS return, defaults to None.
+
+    :raises KeyboardInterrupt: If Ctrl+C is pressed.
+    :raises EOFError: If Ctrl+Z (Windows) or Ctrl+D (Unix) is pressed.
+    """
+    if kbinds is None:
+        kbinds = default_kbinds()
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    foot = ['', 'Use j, k, h, l, arrow keys, space and b to scroll, and q, esc or enter to return'
+            if bottom_note is None else str(bottom_note)]
+    renderer = DiffRenderer()
+    viewport = Viewport(lines, 1)
+    refresh = True
+    while True:
+        if refresh:
+            columns, rows = term_size()
+            if (max(rows - len(foot) - 1, 1), columns) != (viewport.height, viewport.width):
+                viewport.resize(rows - len(foot) - 1, columns)
+                renderer.invalidate()
+            renderer.render(viewport.visible() + [line[:columns] for line in foot])
+            refresh = False
+        key = get_key()
+        refresh = True
+        delta = 0
+        if key in kbinds.SELECT_KEYS or key in kbinds.EXIT_KEYS:
+            return
+        elif key in kbinds.DOWN_KEYS:
+            delta = viewport.scroll_by(1)
+        elif key in kbinds.UP_KEYS:
+            delta = viewport.scroll_by(-1)
+        elif key == ' ':
+            delta = viewport.scroll_by(viewport.height)
+        elif key == 'b':
+            delta = viewport.scroll_by(-viewport.height)
+        elif key in ('l', '\x1b[C', '\xe0M', '\x00M'):
+            viewport.hscroll_by(viewport.width // 2)
+        elif key in ('h', '\x1b[D', '\xe0K', '\x00K'):
+            viewport.hscroll_by(-(viewport.width // 2))
+        else:
+            refresh = False
+        renderer.scroll(0, viewport.height, delta)
+
+
 def variadic(x):
     return (x,) if not isinstance(x, tuple) else x
 